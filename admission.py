@@ -0,0 +1,175 @@
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+
+# 准入优先级：数值越小越优先
+PRIORITY_HIGH = 0  # 第一页，或上游响应已缓存的请求
+PRIORITY_LOW = 1  # 深翻页，需要请求上游并可能触发大量下载转换
+
+
+class Rejected(Exception):
+    """请求未被接纳：status为返回的HTTP状态码，retry_after为建议的重试等待秒数"""
+
+    def __init__(self, status: int, msg: str, retry_after: int):
+        super().__init__(msg)
+        self.status = status
+        self.msg = msg
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """令牌桶：每秒补充rate个令牌，最多积累burst个"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """取一个令牌，成功返回0，否则返回需要等待的秒数"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """全局准入控制：限制同时处理的请求数，其余进入有界的优先级队列
+
+    - 每个wxid一个令牌桶，超出速率直接返回429；
+    - 同时处理的请求达到max_active时排队，高优先级（第一页、已缓存）先出队；
+    - 队列已满时，新请求优先级更高则挤掉队尾最低优先级的请求，否则直接返回503；
+    - 排队超过queue_timeout秒仍未轮到的返回503。
+    被拒绝的请求都带Retry-After，按当前队列长度和平均处理时间估算。
+    排队时间有上限，过载时尾延迟不会无限增长。
+    """
+
+    def __init__(self, performance: Dict):
+        self.max_active = max(1, performance.get('max_active_requests', 8))
+        self.max_queue = performance.get('max_queued_requests', 32)
+        self.queue_timeout = performance.get('queue_timeout', 10)
+        self.rate = performance.get('wxid_rate_limit', 2)
+        self.burst = performance.get('wxid_rate_burst', 10)
+        self.active = 0
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._service_time = 1.0
+        self.admitted = 0
+        self.rate_limited = 0
+        self.shed = 0
+        self.timed_out = 0
+
+    @property
+    def queued(self) -> int:
+        return sum(1 for *_, future in self._queue if not future.done())
+
+    def _retry_after(self) -> int:
+        """按排在前面的请求数和平均处理时间估算的重试等待秒数"""
+        return max(1, math.ceil((self.queued + 1) / self.max_active * self._service_time))
+
+    def _reject(self, status: int, msg: str, result: str, retry_after: Optional[int] = None) -> Rejected:
+        metrics.ADMISSIONS.inc(result=result)
+        return Rejected(status, msg, retry_after or self._retry_after())
+
+    @asynccontextmanager
+    async def admit(self, wxid: str, priority: int = PRIORITY_LOW):
+        """获得处理资格后进入with块；被拒绝时抛出Rejected"""
+        if self.rate > 0:
+            bucket = self._buckets.get(wxid)
+            if bucket is None:
+                bucket = self._buckets[wxid] = TokenBucket(self.rate, self.burst)
+            wait = bucket.take()
+            if wait > 0:
+                self.rate_limited += 1
+                raise self._reject(429, '请求过于频繁，请稍后再试', 'rate_limited', math.ceil(wait))
+
+        if self.active >= self.max_active:
+            await self._wait_turn(priority)
+        else:
+            self.active += 1
+        self.admitted += 1
+        metrics.ADMISSIONS.inc(result='admitted')
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            # 平均处理时间用于估算Retry-After
+            self._service_time = 0.8 * self._service_time + 0.2 * (time.monotonic() - started)
+            self._release()
+
+    async def _wait_turn(self, priority: int):
+        if self.queued >= self.max_queue and not self._shed_for(priority):
+            self.shed += 1
+            raise self._reject(503, '服务繁忙，请稍后再试', 'shed')
+
+        if len(self._queue) > self.max_queue * 2:
+            # 清理已超时、被挤掉或已取消的条目
+            self._queue = [entry for entry in self._queue if not entry[2].done()]
+            heapq.heapify(self._queue)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), future))
+        try:
+            # 出队时由_release把active计入本请求
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                return
+            future.cancel()
+            self.timed_out += 1
+            raise self._reject(503, '服务繁忙，排队超时', 'timed_out')
+        except asyncio.CancelledError:
+            # 客户端断开：已经轮到本请求时把名额交还
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._release()
+            else:
+                future.cancel()
+            raise
+
+    def _shed_for(self, priority: int) -> bool:
+        """队列已满时挤掉一个优先级更低的排队请求，为priority腾出位置"""
+        waiting = [entry for entry in self._queue if not entry[2].done()]
+        if not waiting:
+            return False
+        victim = max(waiting, key=lambda entry: (entry[0], entry[1]))
+        if victim[0] <= priority:
+            return False
+        self.shed += 1
+        victim[2].set_exception(self._reject(503, '服务繁忙，请稍后再试', 'shed'))
+        return True
+
+    def _release(self):
+        """结束一个请求，把名额交给队列中优先级最高的请求"""
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> Dict:
+        waiting = [priority for priority, _, future in self._queue if not future.done()]
+        return {
+            'active': self.active,
+            'max_active': self.max_active,
+            'queued': len(waiting),
+            'queued_high': waiting.count(PRIORITY_HIGH),
+            'queued_low': waiting.count(PRIORITY_LOW),
+            'max_queue': self.max_queue,
+            'avg_service_time': round(self._service_time, 3),
+            'admitted': self.admitted,
+            'rate_limited': self.rate_limited,
+            'shed': self.shed,
+            'timed_out': self.timed_out
+        }
@@ -0,0 +1,212 @@
+"""本地模拟的抖音表情包搜索接口和CDN，用于没有cookie时压测和对比配置
+
+    python bench/fake_douyin.py --port 9000 --api-latency 150 --cdn-latency 40 --cdn-error-rate 0.02
+
+搜索接口路径与抖音一致（/aweme/v1/web/im/resource/emoticon/search），按cursor分页返回
+sticker_list，每个表情包的origin.url_list指向本服务的/cdn/路径。图片素材在首次启动时用
+Pillow生成到--corpus-dir，包含静态和动态的GIF/WebP/PNG，以及不同尺寸和帧数。
+同一个关键词每次返回相同的结果；不同关键词之间按--shared-ratio共享一部分表情包，
+模拟热门表情包出现在多个关键词下的情况。--mirror 在url_list中追加镜像地址（可以是本服务的
+另一个主机名，如 http://localhost:9000），配合--cdn-stall-rate模拟主节点的长尾延迟。
+"""
+import os
+import random
+import asyncio
+import hashlib
+import argparse
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+from aiohttp import web
+
+SEARCH_PATH = '/aweme/v1/web/im/resource/emoticon/search'
+
+# 素材：(文件名, 格式, 宽, 高, 帧数)
+CORPUS = [
+    ('static_small.png', 'PNG', 120, 120, 1),
+    ('static_large.png', 'PNG', 1000, 750, 1),
+    ('static_photo.jpg', 'JPEG', 800, 800, 1),
+    ('static.gif', 'GIF', 240, 240, 1),
+    ('anim_small.gif', 'GIF', 200, 200, 12),
+    ('anim_large.gif', 'GIF', 480, 480, 16),
+    ('anim_small.webp', 'WEBP', 240, 240, 16),
+    ('anim_large.webp', 'WEBP', 600, 600, 20),
+    ('anim_alpha.webp', 'WEBP', 300, 300, 20),
+    ('anim.png', 'PNG', 300, 300, 10),
+]
+
+
+def build_corpus(corpus_dir: str) -> List[str]:
+    """生成素材文件（已存在的跳过），返回文件名列表"""
+    from PIL import Image, ImageDraw
+
+    Path(corpus_dir).mkdir(parents=True, exist_ok=True)
+    for name, fmt, width, height, frames in CORPUS:
+        path = Path(corpus_dir) / name
+        if path.exists():
+            continue
+        rng = random.Random(name)
+        transparent = 'alpha' in name
+        images = []
+        for index in range(frames):
+            background = (0, 0, 0, 0) if transparent else (rng.randrange(256), rng.randrange(256), 255, 255)
+            image = Image.new('RGBA', (width, height), background)
+            draw = ImageDraw.Draw(image)
+            for _ in range(12):
+                x, y = rng.randrange(width), rng.randrange(height)
+                radius = rng.randrange(4, max(5, width // 6))
+                color = (rng.randrange(256), rng.randrange(256), rng.randrange(256), 255)
+                draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color)
+            offset = index * width // max(frames, 1)
+            draw.rectangle((offset, height // 3, offset + width // 8, height // 2), fill=(255, 220, 0, 255))
+            images.append(image if fmt in ('WEBP', 'PNG') else image.convert('RGB'))
+        options = {'save_all': True, 'append_images': images[1:], 'duration': 80, 'loop': 0} if frames > 1 else {}
+        images[0].save(path, fmt, **options)
+    return [name for name, *_ in CORPUS]
+
+
+class FakeDouyin:
+    """模拟接口的状态：素材、分页规则、延迟和错误率，以及请求计数"""
+
+    def __init__(self, corpus_dir: str, page_size: int = 20, pages: int = 5, shared_ratio: float = 0.3,
+                 api_latency: float = 0.1, cdn_latency: float = 0.03, jitter: float = 0.5,
+                 api_error_rate: float = 0.0, cdn_error_rate: float = 0.0, seed: int = 0,
+                 mirrors: Sequence[str] = (), cdn_stall_rate: float = 0.0, cdn_stall: float = 5.0):
+        self.corpus_dir = corpus_dir
+        self.files = build_corpus(corpus_dir)
+        self.page_size = page_size
+        self.pages = pages
+        self.shared_ratio = shared_ratio
+        self.api_latency = api_latency
+        self.cdn_latency = cdn_latency
+        self.jitter = jitter
+        self.api_error_rate = api_error_rate
+        self.cdn_error_rate = cdn_error_rate
+        self.mirrors = list(mirrors)
+        self.cdn_stall_rate = cdn_stall_rate
+        self.cdn_stall = cdn_stall
+        self.random = random.Random(seed)
+        self.counters = {'api_requests': 0, 'api_errors': 0, 'cdn_requests': 0, 'cdn_errors': 0, 'cdn_bytes': 0,
+                         'cdn_stalls': 0, 'mirror_requests': 0}
+
+    def _delay(self, base: float) -> float:
+        return max(0.0, base * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    def stickers(self, keyword: str, page: int) -> List[Dict]:
+        """关键词第page页的表情包，结果固定；一部分来自所有关键词共享的热门池"""
+        stickers = []
+        for index in range(self.page_size):
+            seed = int(hashlib.md5(f'{keyword}/{page}/{index}'.encode('utf-8')).hexdigest()[:8], 16)
+            if seed % 1000 < self.shared_ratio * 1000:
+                identity = f'shared/{seed % 200}'
+            else:
+                identity = f'{keyword}/{page}/{index}'
+            name = self.files[int(hashlib.md5(identity.encode('utf-8')).hexdigest()[:8], 16) % len(self.files)]
+            uri = f'tos-cn-bench/{hashlib.md5(identity.encode("utf-8")).hexdigest()}'
+            stickers.append({
+                'origin': {
+                    'uri': uri,
+                    'url_list': [f'/cdn/{name}?uri={uri}'],
+                    'width': 0,
+                    'height': 0
+                }
+            })
+        return stickers
+
+    async def handle_search(self, request: web.Request) -> web.Response:
+        self.counters['api_requests'] += 1
+        await asyncio.sleep(self._delay(self.api_latency))
+        if self.random.random() < self.api_error_rate:
+            self.counters['api_errors'] += 1
+            return web.json_response({'status_code': 2154, 'status_msg': 'rate limited'}, status=503)
+
+        keyword = request.query.get('keyword', '') or 'home'
+        try:
+            cursor = int(request.query.get('cursor', '0'))
+        except ValueError:
+            cursor = 0
+        page = cursor // self.page_size
+        host = f'{request.scheme}://{request.host}'
+        stickers = self.stickers(keyword, page)
+        for sticker in stickers:
+            url = sticker['origin']['url_list'][0]
+            sticker['origin']['url_list'] = [host + url] + [f'{mirror}{url}&mirror=1' for mirror in self.mirrors]
+        return web.json_response({
+            'status_code': 0,
+            'emoticon_data': {
+                'sticker_list': stickers,
+                'next_cursor': cursor + self.page_size,
+                'has_more': page + 1 < self.pages
+            }
+        })
+
+    async def handle_cdn(self, request: web.Request) -> web.StreamResponse:
+        self.counters['cdn_requests'] += 1
+        if 'mirror' in request.query:
+            self.counters['mirror_requests'] += 1
+        elif self.random.random() < self.cdn_stall_rate:
+            # 主节点偶发的长尾延迟，镜像不受影响
+            self.counters['cdn_stalls'] += 1
+            await asyncio.sleep(self.cdn_stall)
+        await asyncio.sleep(self._delay(self.cdn_latency))
+        if self.random.random() < self.cdn_error_rate:
+            self.counters['cdn_errors'] += 1
+            raise web.HTTPServiceUnavailable()
+        name = request.match_info['name']
+        if name not in self.files:
+            raise web.HTTPNotFound()
+        path = os.path.join(self.corpus_dir, name)
+        self.counters['cdn_bytes'] += os.path.getsize(path)
+        return web.FileResponse(path)
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.counters)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get(SEARCH_PATH, self.handle_search)
+        app.router.add_get('/cdn/{name}', self.handle_cdn)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """模拟接口的参数，压测脚本复用同一组参数"""
+    parser.add_argument('--corpus-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus'),
+                        help='素材目录，不存在时自动生成')
+    parser.add_argument('--page-size', type=int, default=20, help='每页表情包数')
+    parser.add_argument('--pages', type=int, default=5, help='每个关键词的页数')
+    parser.add_argument('--shared-ratio', type=float, default=0.3, help='来自共享热门池的表情包比例')
+    parser.add_argument('--api-latency', type=float, default=0.1, help='搜索接口平均延迟（秒）')
+    parser.add_argument('--cdn-latency', type=float, default=0.03, help='CDN平均延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.5, help='延迟的随机浮动比例')
+    parser.add_argument('--api-error-rate', type=float, default=0.0, help='搜索接口返回错误的概率')
+    parser.add_argument('--cdn-error-rate', type=float, default=0.0, help='CDN返回错误的概率')
+    parser.add_argument('--mirror', action='append', default=[],
+                        help='url_list中追加的镜像地址（如 http://localhost:9000），可重复指定；压测脚本中{port}代表模拟接口的端口')
+    parser.add_argument('--cdn-stall-rate', type=float, default=0.0, help='主节点请求出现长尾延迟的概率，镜像不受影响')
+    parser.add_argument('--cdn-stall', type=float, default=5.0, help='长尾延迟的时长（秒）')
+
+
+def from_arguments(args: argparse.Namespace) -> FakeDouyin:
+    return FakeDouyin(
+        args.corpus_dir, page_size=args.page_size, pages=args.pages, shared_ratio=args.shared_ratio,
+        api_latency=args.api_latency, cdn_latency=args.cdn_latency, jitter=args.jitter,
+        api_error_rate=args.api_error_rate, cdn_error_rate=args.cdn_error_rate,
+        mirrors=args.mirror, cdn_stall_rate=args.cdn_stall_rate, cdn_stall=args.cdn_stall
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟的抖音表情包接口和CDN')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    fake = from_arguments(args)
+    print(f"模拟接口: http://{args.host}:{args.port}{SEARCH_PATH}")
+    web.run_app(fake.create_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""压测用的服务启动器：在server.py的基础上统计各阶段耗时
+
+由run_bench.py在独立进程中启动（工作目录中放置生成的config.py），
+给上游接口、下载、转换三个阶段套上计时，并通过 /bench/stages 返回累计的次数和耗时。
+"""
+import sys
+import time
+import argparse
+from typing import Dict
+
+from aiohttp import web
+
+import server
+
+STAGES: Dict[str, Dict[str, float]] = {}
+
+
+def timed(name: str, func):
+    """包装异步方法，累计调用次数、总耗时和最大耗时"""
+    stage = STAGES.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            stage['count'] += 1
+            stage['total'] += elapsed
+            stage['max'] = max(stage['max'], elapsed)
+    return wrapper
+
+
+async def handle_stages(request: web.Request) -> web.Response:
+    return web.json_response(STAGES)
+
+
+async def create_app() -> web.Application:
+    app = await server.init_app()
+    api = server.api
+    api._fetch_sticker_page = timed('upstream', api._fetch_sticker_page)
+    api._download_image = timed('download', api._download_image)
+    api._convert_image = timed('convert', api._convert_image)
+    app.router.add_get('/bench/stages', handle_stages)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='带阶段计时的表情包API服务')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    web.run_app(create_app(), host='127.0.0.1', port=args.port, access_log=None, print=None,
+                handler_cancellation=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,362 @@
+"""端到端压测：模拟的抖音接口 + 真实的server.py
+
+    # 默认：1/8/32并发，每档200个请求
+    python bench/run_bench.py
+
+    # 对比配置：--set 覆盖config.example.py中的任意配置项（值按Python字面量解析）
+    python bench/run_bench.py --concurrency 16 --set performance.max_concurrent_conversions=6 --set image.quality="'medium'"
+
+    # 只跑转换函数的微基准
+    python bench/run_bench.py --micro-only
+
+服务在独立进程中运行，配置由config.example.py加上覆盖项生成，下载目录为临时目录，
+每次运行都从空仓库开始（同一次运行中后面的并发档会命中前面生成的文件）。
+输出各并发档的p50/p95/p99延迟、每秒请求数、上游/下载/转换各阶段耗时、服务进程
+及转换进程的峰值内存；--micro时另外输出各转换函数在每个素材上的耗时。
+"""
+import os
+import sys
+import ast
+import json
+import time
+import random
+import logging
+import pprint
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import importlib.util
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+import fake_douyin
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+BENCH_WXID = 'wxid_bench'
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def load_example_config() -> Dict[str, Dict]:
+    """用importlib加载config.example.py，不依赖本地的config.py"""
+    spec = importlib.util.spec_from_file_location('config_example', REPO_DIR / 'config.example.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return {name: dict(getattr(module, name)) for name in
+            ('DOUYIN_CONFIG', 'SERVER_CONFIG', 'PERFORMANCE_CONFIG', 'IMAGE_CONFIG')}
+
+
+def apply_overrides(configs: Dict[str, Dict], overrides: List[str]):
+    """--set section.key=value，section为douyin/server/performance/image"""
+    for override in overrides:
+        name, _, raw = override.partition('=')
+        section, _, key = name.partition('.')
+        target = configs.get(f'{section.upper()}_CONFIG')
+        if target is None or not key:
+            raise SystemExit(f'无效的配置覆盖: {override}')
+        try:
+            target[key] = ast.literal_eval(raw)
+        except (ValueError, SyntaxError):
+            target[key] = raw
+
+
+def write_config(workdir: Path, fake_url: str, port: int, overrides: List[str]) -> Dict[str, Dict]:
+    configs = load_example_config()
+    configs['DOUYIN_CONFIG'].update(api_url=fake_url + fake_douyin.SEARCH_PATH, cookie='bench')
+    configs['SERVER_CONFIG'].update(
+        base_url=f'http://127.0.0.1:{port}', download_dir='downloads', allowed_wxids=[BENCH_WXID]
+    )
+    # 压测只用一个wxid，默认关闭按wxid限速并放宽准入队列，否则测到的是限流而不是服务本身；
+    # 响应时限也默认关闭，延迟统计的是完整处理一页的时间。需要时用 --set performance.xxx=... 覆盖
+    configs['PERFORMANCE_CONFIG'].update(
+        enable_warmer=False, wxid_rate_limit=0, max_active_requests=1024, max_queued_requests=4096, queue_timeout=300,
+        response_deadline=0
+    )
+    apply_overrides(configs, overrides)
+    with open(workdir / 'config.py', 'w', encoding='utf-8') as f:
+        for name, value in configs.items():
+            f.write(f'{name} = {pprint.pformat(value)}\n\n')
+    return configs
+
+
+def process_tree(pid: int) -> List[int]:
+    """进程及其所有子进程（Linux /proc）"""
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def peak_rss_mb(pid: int) -> Optional[float]:
+    """进程的峰值常驻内存（VmHWM），非Linux环境返回None"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def memory_report(pid: int) -> Dict:
+    children = [peak_rss_mb(child) for child in process_tree(pid)[1:]]
+    children = [rss for rss in children if rss is not None]
+    return {
+        'server_peak_rss_mb': peak_rss_mb(pid),
+        'workers': len(children),
+        'workers_peak_rss_mb_max': max(children) if children else None,
+        'workers_peak_rss_mb_sum': sum(children) if children else None
+    }
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def request_plan(count: int, keywords: int, pages: int, limit: int, seed: int) -> List[Dict]:
+    """按Zipf分布挑选关键词，大部分请求第一页，少量翻页"""
+    rng = random.Random(seed)
+    names = [f'kw{index}' for index in range(keywords)]
+    weights = [1 / (index + 1) for index in range(keywords)]
+    plan = []
+    for _ in range(count):
+        page = 0 if rng.random() < 0.8 else rng.randrange(1, max(2, pages))
+        plan.append({'keyword': rng.choices(names, weights)[0], 'start': page * limit})
+    return plan
+
+
+async def run_level(session: aiohttp.ClientSession, base_url: str, concurrency: int, plan: List[Dict],
+                    limit: int, fetch_items: bool, extra_params: Dict) -> Dict:
+    latencies: List[float] = []
+    errors = 0
+    items = 0
+    pending = list(plan)
+
+    async def worker():
+        nonlocal errors, items
+        while pending:
+            spec = pending.pop()
+            params = {'ac': 'search', 'wxid': BENCH_WXID, 'keyword': spec['keyword'],
+                      'start': spec['start'], 'limit': limit, **extra_params}
+            started = time.perf_counter()
+            try:
+                async with session.get(f'{base_url}/emoticon_api', params=params) as response:
+                    data = await response.json()
+                if data.get('code') != 200:
+                    errors += 1
+                    continue
+                items += len(data['items'])
+                if fetch_items:
+                    for item in data['items']:
+                        async with session.get(item['url']) as response:
+                            await response.read()
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        'concurrency': concurrency,
+        'requests': len(plan),
+        'errors': errors,
+        'items': items,
+        'elapsed_s': elapsed,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies, default=0.0) * 1000
+    }
+
+
+def stage_delta(before: Dict, after: Dict) -> Dict:
+    """两次 /bench/stages 之间各阶段的次数和平均耗时"""
+    delta = {}
+    for name, stage in after.items():
+        previous = before.get(name, {'count': 0, 'total': 0.0})
+        count = stage['count'] - previous['count']
+        total = stage['total'] - previous['total']
+        delta[name] = {'count': count, 'total_s': total, 'mean_ms': total / count * 1000 if count else 0.0}
+    return delta
+
+
+async def wait_ready(session: aiohttp.ClientSession, base_url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit('服务进程启动失败，详见 server.log')
+        try:
+            async with session.get(f'{base_url}/health') as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit('等待服务启动超时')
+
+
+async def run_end_to_end(args) -> Dict:
+    fake = fake_douyin.from_arguments(args)
+    fake_runner = web.AppRunner(fake.create_app(), access_log=None)
+    await fake_runner.setup()
+    fake_port = free_port()
+    await web.TCPSite(fake_runner, '127.0.0.1', fake_port).start()
+    fake.mirrors = [mirror.replace('{port}', str(fake_port)) for mirror in fake.mirrors]
+
+    workdir = Path(tempfile.mkdtemp(prefix='emoji-bench-'))
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    configs = write_config(workdir, f'http://127.0.0.1:{fake_port}', port, args.set or [])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(workdir), str(REPO_DIR)]))
+    log = open(workdir / 'server.log', 'w')
+    process = subprocess.Popen(
+        [sys.executable, str(BENCH_DIR / 'instrumented_server.py'), '--port', str(port)],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    results = {'config_overrides': args.set or [], 'workdir': str(workdir), 'levels': []}
+    connector = aiohttp.TCPConnector(limit=0)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300)) as session:
+            await wait_ready(session, base_url, process)
+            extra_params = dict(param.split('=', 1) for param in (args.param or []))
+            for level, concurrency in enumerate(int(value) for value in args.concurrency.split(',')):
+                plan = request_plan(args.requests, args.keywords, args.pages, args.limit, seed=level)
+                async with session.get(f'{base_url}/bench/stages') as response:
+                    before = await response.json()
+                result = await run_level(session, base_url, concurrency, plan, args.limit, args.fetch_items, extra_params)
+                async with session.get(f'{base_url}/bench/stages') as response:
+                    result['stages'] = stage_delta(before, await response.json())
+                results['levels'].append(result)
+                print_level(result)
+            async with session.get(f'{base_url}/health') as response:
+                results['server_stats'] = (await response.json()).get('stats')
+            results['memory'] = memory_report(process.pid)
+            results['upstream'] = dict(fake.counters)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        await fake_runner.cleanup()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    results['image_config'] = configs['IMAGE_CONFIG']
+    return results
+
+
+def print_level(result: Dict):
+    print(
+        f"并发 {result['concurrency']:>4}: {result['rps']:8.1f} req/s  "
+        f"p50 {result['p50_ms']:8.1f}ms  p95 {result['p95_ms']:8.1f}ms  p99 {result['p99_ms']:8.1f}ms  "
+        f"错误 {result['errors']}/{result['requests']}"
+    )
+    for name, stage in result['stages'].items():
+        print(f"    {name:<10} {stage['count']:>6} 次  平均 {stage['mean_ms']:8.1f}ms  合计 {stage['total_s']:8.2f}s")
+
+
+def run_micro(args) -> List[Dict]:
+    """各转换函数在每个素材上的耗时（当前进程内执行，取多次的中位数）"""
+    sys.path.insert(0, str(REPO_DIR))
+    import converter
+
+    # 转换成功的日志会刷屏，微基准只保留警告
+    logging.getLogger('converter').setLevel(logging.WARNING)
+    image_config = load_example_config()['IMAGE_CONFIG']
+    converter.init_worker()
+    files = fake_douyin.build_corpus(args.corpus_dir)
+    output_dir = Path(tempfile.mkdtemp(prefix='emoji-micro-'))
+    operations = [
+        ('probe', lambda source, out: converter.probe(source) is not None),
+        ('gif', lambda source, out: converter.convert_to_gif(source, out + '.gif', image_config, check_passthrough=False)),
+        ('passthrough', lambda source, out: converter.can_passthrough(converter.probe(source), image_config)
+            and converter.passthrough(source, out + '.gif')),
+    ]
+    operations += [
+        (fmt, lambda source, out, fmt=fmt: converter.convert(source, f'{out}.{fmt}', image_config))
+        for fmt in ('webp', 'png', 'mp4') if fmt in converter.available_formats()
+    ]
+
+    results = []
+    try:
+        for name in files:
+            path = os.path.join(args.corpus_dir, name)
+            with open(path, 'rb') as f:
+                source = f.read()
+            for operation, func in operations:
+                timings = []
+                success = False
+                for _ in range(args.micro_repeat):
+                    started = time.perf_counter()
+                    success = bool(func(source, str(output_dir / f'{name}.{operation}')))
+                    timings.append(time.perf_counter() - started)
+                if not success:
+                    continue
+                median = sorted(timings)[len(timings) // 2]
+                results.append({
+                    'file': name, 'operation': operation, 'ms': median * 1000,
+                    'mb_per_s': len(source) / 1024 / 1024 / median if median else 0.0
+                })
+                print(f"{name:<18} {operation:<12} {median * 1000:9.2f}ms  {results[-1]['mb_per_s']:8.2f}MB/s")
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='表情包API端到端压测')
+    parser.add_argument('--concurrency', default='1,8,32', help='并发档位，逗号分隔')
+    parser.add_argument('--requests', type=int, default=200, help='每个并发档的请求数')
+    parser.add_argument('--keywords', type=int, default=50, help='关键词数量（按Zipf分布挑选）')
+    parser.add_argument('--limit', type=int, default=20, help='每个请求的limit')
+    parser.add_argument('--fetch-items', action='store_true', help='同时下载返回的每个表情包')
+    parser.add_argument('--param', action='append', help='额外的请求参数，如 format=webp')
+    parser.add_argument('--set', action='append', help='覆盖配置项，如 performance.max_concurrent_downloads=16')
+    parser.add_argument('--micro', action='store_true', help='额外运行转换函数微基准')
+    parser.add_argument('--micro-only', action='store_true', help='只运行转换函数微基准')
+    parser.add_argument('--micro-repeat', type=int, default=3, help='微基准每项重复次数')
+    parser.add_argument('--json', help='把结果写入JSON文件')
+    parser.add_argument('--keep-workdir', action='store_true', help='保留服务的临时工作目录（含server.log）')
+    fake_douyin.add_arguments(parser)
+    args = parser.parse_args()
+
+    results = {}
+    if not args.micro_only:
+        results['end_to_end'] = asyncio.run(run_end_to_end(args))
+        memory = results['end_to_end']['memory']
+        print(f"峰值内存: 服务进程 {memory['server_peak_rss_mb']}MB，"
+              f"转换进程 {memory['workers']} 个，最大 {memory['workers_peak_rss_mb_max']}MB")
+        print(f"上游请求: {results['end_to_end']['upstream']}")
+    if args.micro or args.micro_only:
+        results['micro'] = run_micro(args)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,325 @@
+import os
+import json
+import asyncio
+import time
+import sqlite3
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows没有fcntl，跨进程锁退化为无操作
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 打开共享数据库时切换WAL模式的最多尝试次数
+WAL_ATTEMPTS = 100
+
+
+def connect_sqlite(db_path: str) -> sqlite3.Connection:
+    """打开SQLite数据库并切换到WAL模式，多个进程可以同时读写
+
+    多个服务进程同时启动、同时初始化同一个数据库时，切换日志模式会因数据库被锁定立即失败（不等待busy超时），稍后重试。
+    """
+    db = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+    for attempt in range(WAL_ATTEMPTS):
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            return db
+        except sqlite3.OperationalError:
+            if attempt == WAL_ATTEMPTS - 1:
+                db.close()
+                raise
+            time.sleep(0.05)
+
+
+class SingleFlight:
+    """合并并发的相同调用：同一个key同一时间只执行一次，其余调用者等待并共享结果
+
+    cancel_abandoned为True时按调用者计数：等待同一调用的调用者全部被取消（客户端断开）后，
+    进行中的调用也随之取消；还有其他调用者（包括后台预取、预热）在等待时继续执行。
+    """
+
+    def __init__(self, cancel_abandoned: bool = False):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+        self.cancel_abandoned = cancel_abandoned
+        self.abandoned = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """执行func并返回(结果, 是否复用了进行中的调用)"""
+        task = self._inflight.get(key)
+        shared = task is not None
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # shield：某个调用者被取消时，不影响其他仍在等待的调用者
+            return await asyncio.shield(task), shared
+        finally:
+            self._waiters[task] -= 1
+            if self._waiters[task] == 0:
+                del self._waiters[task]
+                if self.cancel_abandoned and not task.done():
+                    # 已经没有调用者在等待：取消调用，之后的调用者重新开始
+                    self.abandoned += 1
+                    if self._inflight.get(key) is task:
+                        del self._inflight[key]
+                    task.cancel()
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f"合并调用失败 {key}: {task.exception()}")
+
+
+class FileLock:
+    """跨进程文件锁（fcntl.flock），用非阻塞方式轮询获取，不阻塞事件循环"""
+
+    def __init__(self, path: str, poll_interval: float = 0.05):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._fd: Optional[int] = None
+
+    async def __aenter__(self):
+        if fcntl is None:
+            return self
+        self._fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            while True:
+                try:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return self
+                except BlockingIOError:
+                    await asyncio.sleep(self.poll_interval)
+        except BaseException:
+            os.close(self._fd)
+            self._fd = None
+            raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+class ResponseCache:
+    """上游响应缓存：TTL过期 + LRU淘汰，并发的相同查询合并为一次上游请求
+
+    配置db_path时（多进程模式）同时写入SQLite，其他进程内存未命中时从中读取；
+    未命中的查询按key哈希加文件锁后再请求上游，多个进程的相同查询也只请求一次。
+    共享时的值需要能用JSON序列化。
+    """
+
+    LOCK_STRIPES = 64
+
+    def __init__(self, ttl: float = 60, max_entries: int = 1000, db_path: Optional[str] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+        self._flight = SingleFlight()
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock_dir = None
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        if db_path and ttl > 0:
+            self._db = connect_sqlite(db_path)
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, value TEXT)')
+            self._lock_dir = f'{db_path}.locks'
+            os.makedirs(self._lock_dir, exist_ok=True)
+
+    @staticmethod
+    def _db_key(key: Hashable) -> str:
+        return json.dumps(key, ensure_ascii=False)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """读取未过期的缓存，命中时刷新LRU位置；内存未命中时查共享的SQLite"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return self._get_shared(key)
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return self._get_shared(key)
+        self._entries.move_to_end(key)
+        return value
+
+    def _get_shared(self, key: Hashable) -> Optional[Any]:
+        if self._db is None:
+            return None
+        row = self._db.execute('SELECT expires, value FROM responses WHERE key = ?', (self._db_key(key),)).fetchone()
+        if row is None or row[0] <= time.time():
+            return None
+        value = json.loads(row[1])
+        self._remember(key, value, row[0] - time.time())
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        self._remember(key, value, self.ttl)
+        if self._db is not None:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses (key, expires, value) VALUES (?, ?, ?)',
+                (self._db_key(key), time.time() + self.ttl, json.dumps(value, ensure_ascii=False))
+            )
+            self._writes += 1
+            if self._writes % 500 == 0:
+                self._db.execute('DELETE FROM responses WHERE expires <= ?', (time.time(),))
+
+    def _remember(self, key: Hashable, value: Any, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _lock_path(self, key: Hashable) -> str:
+        stripe = int(hashlib.sha1(self._db_key(key).encode('utf-8')).hexdigest()[:8], 16) % self.LOCK_STRIPES
+        return os.path.join(self._lock_dir, f'{stripe:02d}.lock')
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """优先返回缓存；未命中时调用fetch，结果为None视为失败不缓存"""
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        async def load():
+            if self._db is None:
+                return await fetch_and_store()
+            # 其他进程可能正在请求同一个查询，拿到锁后先看它是否已经写入
+            async with FileLock(self._lock_path(key)):
+                cached = self._get_shared(key)
+                if cached is not None:
+                    return cached
+                return await fetch_and_store()
+
+        async def fetch_and_store():
+            result = await fetch()
+            if result is not None:
+                self.set(key, result)
+            return result
+
+        value, shared = await self._flight.do(key, load)
+        if shared:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        return value
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def stats(self) -> Dict:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'inflight': len(self._flight)
+        }
+
+
+class CursorStore:
+    """分页cursor存储：记录每个查询第N页对应的抖音cursor
+
+    内存中按LRU保留最多max_entries条，超过max_age秒的记录视为失效；
+    配置db_path时同步写入SQLite，重启后仍能继续翻页；多个进程共用同一个文件时，
+    内存未命中会再查SQLite，各进程看到的cursor一致。
+    """
+
+    def __init__(self, max_entries: int = 10000, max_age: float = 3600, db_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries: 'OrderedDict[Tuple[str, str, int], Tuple[float, str]]' = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        self._writes = 0
+        if db_path:
+            self._db = connect_sqlite(db_path)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS cursors ('
+                'ac TEXT, keyword TEXT, start INTEGER, cursor TEXT, updated REAL, '
+                'PRIMARY KEY (ac, keyword, start))'
+            )
+            self._load()
+
+    def _load(self):
+        """从SQLite加载未过期的记录"""
+        self._prune_db()
+        rows = self._db.execute(
+            'SELECT ac, keyword, start, cursor, updated FROM cursors ORDER BY updated DESC LIMIT ?',
+            (self.max_entries,)
+        ).fetchall()
+        for ac, keyword, start, cursor, updated in reversed(rows):
+            self._entries[(ac, keyword, start)] = (updated, cursor)
+        logger.info(f"已加载 {len(rows)} 条分页cursor")
+
+    def _prune_db(self):
+        self._db.execute('DELETE FROM cursors WHERE updated < ?', (time.time() - self.max_age,))
+        self._db.execute(
+            'DELETE FROM cursors WHERE rowid NOT IN '
+            '(SELECT rowid FROM cursors ORDER BY updated DESC LIMIT ?)',
+            (self.max_entries,)
+        )
+
+    def get(self, ac: str, keyword: str, start: int) -> Optional[str]:
+        """内存未命中时查SQLite，多进程模式下能读到其他进程记录的cursor"""
+        key = (ac, keyword, start)
+        entry = self._entries.get(key)
+        if entry is None and self._db is not None:
+            row = self._db.execute(
+                'SELECT updated, cursor FROM cursors WHERE ac = ? AND keyword = ? AND start = ?', key
+            ).fetchone()
+            if row is not None:
+                entry = self._entries[key] = row
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        if entry is None:
+            return None
+        updated, cursor = entry
+        if time.time() - updated > self.max_age:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return cursor
+
+    def set(self, ac: str, keyword: str, start: int, cursor: str):
+        now = time.time()
+        key = (ac, keyword, start)
+        self._entries[key] = (now, cursor)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        if self._db is not None:
+            self._db.execute(
+                'INSERT OR REPLACE INTO cursors (ac, keyword, start, cursor, updated) VALUES (?, ?, ?, ?, ?)',
+                (ac, keyword, start, cursor, now)
+            )
+            self._writes += 1
+            if self._writes % 500 == 0:
+                self._prune_db()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -17,23 +17,72 @@ SERVER_CONFIG = {
         'wxid_888888',  # 添加允许访问的wxid
         'wxid_999999',
     ],
+    'workers': 1,  # 服务进程数，大于1时多个进程共用端口（需要系统支持SO_REUSEPORT），kill -HUP 主进程可平滑重启
 }
 
 # 性能配置
 PERFORMANCE_CONFIG = {
-    'max_concurrent_downloads': 1,  # 并发下载数量
-    'max_concurrent_conversions': 3,  # 并发转换数量
-    'download_timeout': 30,  # 下载超时时间（秒）
-    'conversion_timeout': 60,  # 转换超时时间（秒）
-    'enable_parallel': True,  # 启用并行处理
+    'max_concurrent_downloads': 8,  # 并发下载数量（下载阶段）
+    'max_concurrent_conversions': None,  # 并发转换数量（转换阶段），None表示与转换进程池大小相同
+    'download_timeout': 30,  # 下载超时时间（秒），有足够延迟样本后按主机近期延迟自适应缩短
+    'conversion_timeout': 60,  # 转换超时时间（秒），从转换进程开始执行时计时，超时的转换任务直接判定失败
+    'conversion_workers': None,  # 每个服务进程的转换进程池大小，None表示各服务进程平分全部CPU核心
+    'enable_parallel': True,  # 启用并行处理，关闭后两个阶段都只用1个并发
     'enable_cache': True,  # 启用缓存
+    'response_cache_ttl': 60,  # 抖音搜索结果缓存时间（秒）
+    'response_cache_size': 1000,  # 抖音搜索结果最多缓存条数，超出按LRU淘汰
+    'cursor_store_size': 10000,  # 分页cursor最多保存条数
+    'cursor_max_age': 3600,  # 分页cursor有效期（秒）
+    'cursor_db': 'cursors.db',  # 分页cursor持久化的SQLite文件，None表示只保存在内存（workers大于1时为 download_dir/cursors.db）
+    'store_max_bytes': 2 * 1024 * 1024 * 1024,  # 表情包仓库容量上限（字节），超出按最近访问时间淘汰到上限的90%，0表示不限制
+    'store_db': None,  # 仓库索引SQLite文件，None表示使用 download_dir/store.db
+    'conversion_file_lock': False,  # 多个进程共用下载目录时开启，转换时用文件锁避免重复转换同一个表情包（workers大于1时自动开启）
+    'response_cache_db': None,  # 上游响应缓存的共享SQLite文件，None表示只在内存中；workers大于1时默认 download_dir/responses.db
+    'max_active_requests': 8,  # 同时处理的列表请求数，超出的排队（第一页和已缓存的请求优先）
+    'max_queued_requests': 32,  # 排队的请求数上限，超出时直接返回503和Retry-After
+    'queue_timeout': 10,  # 排队超过该秒数仍未轮到的请求返回503
+    'wxid_rate_limit': 2,  # 每个wxid每秒允许的请求数（令牌桶），超出返回429，0表示不限制
+    'wxid_rate_burst': 10,  # 每个wxid允许的突发请求数
+    'response_deadline': 15,  # 列表请求的响应时限（秒），到时只返回已就绪的表情包，其余在后台继续转换；0表示等待全部完成
+    'max_response_deadline': 60,  # 请求参数deadline允许的最大值（秒），请求deadline=0（不限制）时也按该值处理
+    'hedge_downloads': True,  # 对冲下载：主镜像超过近期p95延迟仍未完成时，向url_list中的下一个镜像再发一个请求，取先完成的
+    'hedge_max_mirrors': 2,  # 同时请求的镜像数上限
+    'hedge_delay': 1.0,  # 延迟样本不足时，发出对冲请求前的等待时间（秒）
+    'breaker_failures': 5,  # 同一主机连续失败该次数后熔断，冷却期内直接跳过
+    'breaker_cooldown': 30,  # 熔断冷却时间（秒），之后放行一个探测请求
+    'adaptive_timeout_factor': 3,  # 自适应的连接和读取超时为该主机近期p99延迟乘以该系数，不超过各请求头方案的超时；总超时仍按配置
+    'min_download_timeout': 2,  # 自适应超时的下限（秒）
+    'latency_window': 100,  # 每个主机保留的最近延迟样本数
+    'max_batch_queries': 20,  # 批量接口单次最多包含的查询数
+    'enable_prefetch': True,  # 返回第N页时后台预取并转换第N+1页
+    'lazy_conversion': False,  # 懒转换模式：接口只调用一次抖音API就返回URL，表情包在首次被访问时才下载转换
+    'static_cache_control': 'public, max-age=31536000, immutable',  # 仓库文件的Cache-Control；修改IMAGE_CONFIG后同一URL内容会变化，需要时可改短
+    'hot_cache_bytes': 64 * 1024 * 1024,  # 内存中热点文件层的总字节数上限，0表示关闭
+    'hot_cache_max_file': 2 * 1024 * 1024,  # 超过该字节数的文件不放入内存层
+    'enable_warmer': True,  # 后台定时预热热门查询的第一页，服务空闲时才进行
+    'warm_interval': 600,  # 预热间隔（秒）
+    'warm_start_delay': 30,  # 启动后首次预热前的等待时间（秒）
+    'warm_keywords': [],  # 固定预热的搜索关键词
+    'warm_feeds': ['home'],  # 固定预热的无关键词列表（ac取值）
+    'warm_top_n': 50,  # 另外预热线上请求中最热门的前N个查询
+    'warm_batch_size': 4,  # 每批转换的表情包数，每批之间检查是否有线上请求
+    'http_pool_size': 100,  # HTTP连接池总连接数
+    'http_pool_per_host': 16,  # 单个主机的最大连接数
+    'dns_cache_ttl': 300,  # DNS缓存时间（秒）
+    'keepalive_timeout': 30,  # 空闲连接保活时间（秒）
+    'memory_spill_threshold': 8 * 1024 * 1024,  # 下载内容超过该字节数时转存临时文件，否则只在内存中处理
     'retry_delay': 0.5,  # 重试延迟（秒）
     'max_retries': 2  # 最大重试次数
 }
 
 # 图片处理配置
 IMAGE_CONFIG = {
-    'max_image_size': 900,  # 最大图片尺寸
-    'gif_fps': 15,  # GIF帧率
-    'quality': 'high'  # 图片质量
+    'max_image_size': 900,  # 最大图片尺寸（full档位）
+    'size_tiers': {'thumb': 120, 'medium': 360},  # 缩小的尺寸档位：名称 -> 最长边像素
+    'list_tier': 'full',  # 列表默认返回的档位，非full时条目附带full_url，原尺寸首次访问时生成
+    'gif_fps': 15,  # 源文件没有帧时长信息时使用的GIF帧率
+    'max_frames': 500,  # 动图最多处理的帧数，超出部分丢弃
+    'max_pixels': 4096 * 4096,  # 单帧最大像素数，超出则拒绝转换
+    'quality': 'high',  # 图片质量：high/medium/low，对应256/128/64色调色板
+    'max_gif_bytes': 0  # 单个GIF的字节预算，超出时降低帧率和尺寸重新编码，0为不限制
 }
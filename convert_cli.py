@@ -0,0 +1,236 @@
+"""离线批量转换工具
+
+不经过HTTP服务，直接用转换进程池把本地图片转换进表情包仓库，用于新节点预先填充仓库，
+或IMAGE_CONFIG修改后重新生成已有文件。全程只读取本地文件，不访问网络。
+
+    # 目录模式：文件名（不含扩展名）必须是服务端使用的40位key，即抖音uri的sha1，其他文件跳过
+    python convert_cli.py --source-dir ./raw
+
+    # 导出模式：读取保存的sticker_list响应（JSON或每行一个JSON），原图按key或URL文件名在media-dir中查找
+    python convert_cli.py --dump stickers.json --media-dir ./media --format gif --format webp --size thumb
+
+已是最新（文件存在且由当前转换配置生成）的输出会跳过；每完成一个文件立即写入仓库索引，
+中断后重新运行即可从断点继续。
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from urllib.parse import urlparse
+from typing import Dict, Iterator, List, Tuple
+
+import converter
+from store import FULL_TIER, EmojiStore, tier_image_configs
+from config import SERVER_CONFIG, PERFORMANCE_CONFIG, IMAGE_CONFIG
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+KEY_RE = re.compile(r'^[0-9a-f]{40}$')
+
+# 进度输出间隔（秒）
+REPORT_INTERVAL = 5
+
+
+def scan_directory(source_dir: str) -> Iterator[Tuple[str, Path, List[str]]]:
+    """目录模式：产出(key, 原图路径, 原图URL列表)
+
+    服务端按抖音uri计算key，单凭文件名无法还原，所以只接受以40位key命名的文件；
+    文件名不是key的跳过，这类原图需要用导出模式（按保存的sticker_list计算key）转换。
+    """
+    skipped = 0
+    for path in sorted(Path(source_dir).rglob('*')):
+        if not path.is_file() or path.name.startswith('.'):
+            continue
+        if not KEY_RE.match(path.stem):
+            skipped += 1
+            logger.warning(f"文件名不是40位key，跳过: {path}")
+            continue
+        yield path.stem, path, []
+    if skipped:
+        logger.warning(f"共 {skipped} 个文件名不是40位key的文件被跳过，请改用 --dump 导出模式")
+
+
+def load_stickers(dump_path: str) -> List[Dict]:
+    """读取保存的sticker_list：支持单个响应、响应列表、表情包列表，以及每行一个JSON"""
+    with open(dump_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+        documents = data if isinstance(data, list) else [data]
+    except json.JSONDecodeError:
+        documents = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    stickers = []
+    for document in documents:
+        if 'origin' in document:
+            stickers.append(document)
+            continue
+        emoticon_data = document.get('emoticon_data', document)
+        stickers.extend(emoticon_data.get('sticker_list') or [])
+    return stickers
+
+
+def scan_dump(dump_path: str, media_dir: str) -> Iterator[Tuple[str, Path, List[str]]]:
+    """导出模式：按key、URL文件名或uri末段在media_dir中查找原图"""
+    media: Dict[str, Path] = {}
+    for path in Path(media_dir).rglob('*'):
+        if path.is_file():
+            media.setdefault(path.name, path)
+            media.setdefault(path.stem, path)
+
+    missing = 0
+    for sticker in load_stickers(dump_path):
+        key = EmojiStore.key_for(sticker)
+        if not key:
+            continue
+        origin = sticker.get('origin', {})
+        urls = origin.get('url_list', [])
+        candidates = [key]
+        for url in urls:
+            name = Path(urlparse(url).path).name
+            candidates += [name, Path(name).stem]
+        if origin.get('uri'):
+            candidates.append(origin['uri'].rsplit('/', 1)[-1])
+        source = next((media[name] for name in candidates if name in media), None)
+        if source is None:
+            missing += 1
+            logger.warning(f"找不到原图: {key}")
+            continue
+        yield key, source, urls
+    if missing:
+        logger.warning(f"共 {missing} 个表情包在 {media_dir} 中找不到原图")
+
+
+class Progress:
+    """统计并定期输出吞吐量"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.converted = 0
+        self.skipped = 0
+        self.failed = 0
+        self.source_bytes = 0
+        self.output_bytes = 0
+
+    def report(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self.last_report < REPORT_INTERVAL:
+            return
+        self.last_report = now
+        elapsed = max(now - self.started, 1e-6)
+        logger.info(
+            f"已转换 {self.converted}，跳过 {self.skipped}，失败 {self.failed}；"
+            f"{self.converted / elapsed:.1f} 个/秒，读取 {self.source_bytes / elapsed / 1024 / 1024:.2f}MB/秒，"
+            f"输出 {self.output_bytes / 1024 / 1024:.1f}MB，耗时 {elapsed:.1f}秒"
+        )
+
+
+def run(sources: Iterator[Tuple[str, Path, List[str]]], store: EmojiStore, formats: List[str],
+        tiers: List[str], workers: int, force: bool = False) -> Progress:
+    """把所有来源按格式×尺寸档位转换进仓库，进程池中最多排队workers*4个任务"""
+    configs = tier_image_configs(IMAGE_CONFIG)
+    fingerprints = {tier: converter.config_fingerprint(configs[tier]) for tier in tiers}
+    progress = Progress()
+    seen = set()
+
+    def jobs():
+        for key, source, urls in sources:
+            if key in seen:
+                continue
+            seen.add(key)
+            for output_format in formats:
+                for tier in tiers:
+                    path = store.path_for(key, output_format, tier)
+                    if not force and store.is_current(path, fingerprints[tier]):
+                        progress.skipped += 1
+                        continue
+                    yield path, key, urls, source, tier
+
+    def finish(done):
+        for future in done:
+            path, key, urls, source, tier = inflight.pop(future)
+            try:
+                success = future.result()
+            except Exception as e:
+                logger.error(f"转换失败 {source}: {e}")
+                success = False
+            if success:
+                store.add(path, key, urls, fingerprints[tier])
+                progress.converted += 1
+                progress.source_bytes += source.stat().st_size
+                progress.output_bytes += store.absolute(path).stat().st_size
+            else:
+                progress.failed += 1
+        progress.report()
+
+    inflight = {}
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=converter.init_worker)
+    try:
+        for path, key, urls, source, tier in jobs():
+            if len(inflight) >= workers * 4:
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                finish(done)
+            future = executor.submit(converter.convert, str(source), str(store.absolute(path)), configs[tier])
+            inflight[future] = (path, key, urls, source, tier)
+        while inflight:
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            finish(done)
+    finally:
+        # 中断时丢弃未开始的任务；已完成的文件都已写入索引，重新运行时会跳过
+        executor.shutdown(wait=True, cancel_futures=True)
+    return progress
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description='离线批量转换表情包到仓库')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--source-dir', help='原图目录，文件名（不含扩展名）须为40位key')
+    source.add_argument('--dump', help='保存的sticker_list响应JSON文件')
+    parser.add_argument('--media-dir', help='导出模式下原图所在目录')
+    parser.add_argument('--format', action='append', dest='formats', help='输出格式，可重复指定，默认gif')
+    parser.add_argument('--size', action='append', dest='tiers', help=f'尺寸档位，可重复指定，默认{FULL_TIER}')
+    parser.add_argument('--workers', type=int, default=None, help='转换进程数，默认使用全部CPU核心')
+    parser.add_argument('--download-dir', default=SERVER_CONFIG['download_dir'], help='仓库所在的下载目录')
+    parser.add_argument('--force', action='store_true', help='忽略已有文件，全部重新转换')
+    args = parser.parse_args(argv)
+
+    if args.dump and not args.media_dir:
+        parser.error('--dump 需要同时指定 --media-dir')
+    formats = args.formats or ['gif']
+    unavailable = [fmt for fmt in formats if fmt not in converter.available_formats()]
+    if unavailable:
+        parser.error(f"当前环境无法输出: {', '.join(unavailable)}")
+    tiers = args.tiers or [FULL_TIER]
+    unknown = [tier for tier in tiers if tier not in tier_image_configs(IMAGE_CONFIG)]
+    if unknown:
+        parser.error(f"未配置的尺寸档位: {', '.join(unknown)}")
+
+    workers = args.workers or PERFORMANCE_CONFIG.get('conversion_workers') or os.cpu_count() or 1
+    store = EmojiStore(
+        args.download_dir,
+        max_bytes=PERFORMANCE_CONFIG.get('store_max_bytes', 0),
+        db_path=PERFORMANCE_CONFIG.get('store_db')
+    )
+    sources = scan_dump(args.dump, args.media_dir) if args.dump else scan_directory(args.source_dir)
+    logger.info(f"开始转换: 格式 {formats}，尺寸 {tiers}，进程数 {workers}")
+    progress = None
+    try:
+        progress = run(sources, store, formats, tiers, workers, args.force)
+    except KeyboardInterrupt:
+        logger.warning("已中断，重新运行即可继续")
+        return 130
+    finally:
+        store.close()
+    progress.report(force=True)
+    return 1 if progress.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
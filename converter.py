@@ -0,0 +1,902 @@
+import os
+import json
+import mmap
+import time
+import hashlib
+import shutil
+import struct
+import logging
+from io import BytesIO
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+
+# 支持的输出格式，按输出文件扩展名区分；mp4需要安装imageio-ffmpeg
+OUTPUT_FORMATS = ('gif', 'webp', 'mp4', 'png')
+
+# 画质档位对应的调色板颜色数
+QUALITY_COLORS = {'high': 256, 'medium': 128, 'low': 64}
+
+# 画质档位对应的WebP有损压缩质量
+WEBP_QUALITY = {'high': 90, 'medium': 75, 'low': 60}
+
+# 超出字节预算时依次尝试的(尺寸比例, 抽帧间隔)
+BUDGET_STEPS = [(1.0, 1), (1.0, 2), (0.75, 2), (0.5, 3), (0.35, 4)]
+
+
+# 本次转换最终成功的方案，convert_with_report返回给主进程记录指标
+_report: Dict = {}
+
+
+class ConversionRejected(Exception):
+    """输入超出转换限制（画布过大等），不再尝试其他转换方案"""
+
+
+def init_worker():
+    """转换进程初始化：预先导入图像库，避免首个任务承担导入开销"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    import numpy  # noqa: F401
+    import imageio  # noqa: F401
+    from PIL import Image
+    Image.init()
+
+
+def warm_up() -> bool:
+    """空任务，用于启动时拉起并预热进程池中的工作进程"""
+    return True
+
+
+def config_fingerprint(image_config: Dict) -> str:
+    """转换配置的指纹，配置变化后据此判断已有文件需要重新生成"""
+    encoded = json.dumps(image_config, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+def available_formats() -> List[str]:
+    """当前环境可以输出的格式"""
+    from PIL import features
+
+    formats = ['gif', 'png']
+    if features.check('webp'):
+        formats.append('webp')
+    try:
+        import imageio_ffmpeg  # noqa: F401
+        formats.append('mp4')
+    except ImportError:
+        pass
+    return formats
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """根据文件头魔数判断图片格式"""
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if data[:2] == b'BM':
+        return 'bmp'
+    return None
+
+
+def probe(source: Union[bytes, str]) -> Optional[Dict]:
+    """只解析文件头和块结构，取得格式、尺寸和帧数，不解码像素
+
+    source为内存数据或文件路径（文件通过mmap读取），无法识别或结构损坏时返回None。
+    """
+    if isinstance(source, (bytes, bytearray)):
+        return _probe_bytes(source)
+    try:
+        with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _probe_bytes(data)
+    except (OSError, ValueError):
+        return None
+
+
+def _probe_bytes(data) -> Optional[Dict]:
+    fmt = sniff_format(data[:16])
+    try:
+        if fmt == 'gif':
+            width, height = struct.unpack('<HH', data[6:10])
+            frames = _count_gif_frames(data)
+        elif fmt == 'webp':
+            width, height, frames = _probe_webp(data)
+        elif fmt == 'png':
+            width, height = struct.unpack('>II', data[16:24])
+            frames = _count_png_frames(data)
+        elif fmt == 'jpeg':
+            width, height = _probe_jpeg(data)
+            frames = 1
+        elif fmt == 'bmp':
+            width, height = struct.unpack('<ii', data[18:26])
+            height = abs(height)
+            frames = 1
+        else:
+            return None
+    except (struct.error, IndexError, ValueError):
+        return None
+    return {'format': fmt, 'width': width, 'height': height, 'frames': frames, 'bytes': len(data)}
+
+
+def _count_gif_frames(data) -> int:
+    """逐块跳过GIF数据（不做LZW解码）统计帧数，没有正常结束时视为损坏"""
+    packed = data[10]
+    pos = 13
+    if packed & 0x80:
+        pos += 3 * (2 << (packed & 0x07))
+    frames = 0
+    while True:
+        block = data[pos]
+        if block == 0x3b:
+            return frames
+        if block == 0x21:
+            pos += 2
+        elif block == 0x2c:
+            flags = data[pos + 9]
+            pos += 10
+            if flags & 0x80:
+                pos += 3 * (2 << (flags & 0x07))
+            pos += 1
+            frames += 1
+        else:
+            raise ValueError('无效的GIF块')
+        while data[pos]:
+            pos += data[pos] + 1
+        pos += 1
+
+
+def _probe_webp(data) -> Tuple[int, int, int]:
+    """读取RIFF块头：VP8X中的画布尺寸，动图按ANMF块计数"""
+    width = height = None
+    frames = 0
+    pos = 12
+    end = min(len(data), 8 + struct.unpack('<I', data[4:8])[0])
+    while pos + 8 <= end:
+        fourcc = data[pos:pos + 4]
+        size = struct.unpack('<I', data[pos + 4:pos + 8])[0]
+        payload = pos + 8
+        if fourcc == b'VP8X':
+            width = 1 + int.from_bytes(data[payload + 4:payload + 7], 'little')
+            height = 1 + int.from_bytes(data[payload + 7:payload + 10], 'little')
+        elif fourcc == b'ANMF':
+            frames += 1
+        elif width is None and fourcc == b'VP8 ':
+            width, height = struct.unpack('<HH', data[payload + 6:payload + 10])
+            width, height = width & 0x3fff, height & 0x3fff
+        elif width is None and fourcc == b'VP8L':
+            bits = struct.unpack('<I', data[payload + 1:payload + 5])[0]
+            width, height = (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        pos = payload + size + (size & 1)
+    if width is None:
+        raise ValueError('缺少WebP图像块')
+    return width, height, max(frames, 1)
+
+
+def _count_png_frames(data) -> int:
+    """APNG在IDAT之前的acTL块中记录帧数"""
+    pos = 8
+    while pos + 8 <= len(data):
+        length, chunk = struct.unpack('>I4s', data[pos:pos + 8])
+        if chunk == b'acTL':
+            return struct.unpack('>I', data[pos + 8:pos + 12])[0]
+        if chunk == b'IDAT':
+            break
+        pos += 12 + length
+    return 1
+
+
+def _probe_jpeg(data) -> Tuple[int, int]:
+    """跳过各个段，读取SOF段中的尺寸"""
+    pos = 2
+    while pos + 9 <= len(data):
+        if data[pos] != 0xff:
+            raise ValueError('无效的JPEG段')
+        marker = data[pos + 1]
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + struct.unpack('>H', data[pos + 2:pos + 4])[0]
+    raise ValueError('缺少SOF段')
+
+
+def can_passthrough(info: Optional[Dict], image_config: Dict) -> bool:
+    """已经符合输出要求的GIF可以原样保存，不需要解码和重新编码"""
+    if not info or info['format'] != 'gif':
+        return False
+    budget = image_config.get('max_gif_bytes', 0)
+    return (
+        max(info['width'], info['height']) <= image_config['max_image_size']
+        and info['width'] * info['height'] <= image_config.get('max_pixels', 4096 * 4096)
+        and info['frames'] <= image_config.get('max_frames', 500)
+        and (not budget or info['bytes'] <= budget)
+    )
+
+
+def passthrough(source: Union[bytes, str], output_path: str) -> bool:
+    """原样保存符合要求的GIF，同样先写临时文件再原子替换"""
+    output_path = Path(output_path)
+    temp_path = _temp_path(output_path)
+    try:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        if not _copy_source(source if isinstance(source, str) else bytes(source), temp_path):
+            return False
+        os.replace(temp_path, output_path)
+        return True
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def _temp_path(output_path: Path) -> Path:
+    return output_path.with_name(f".{output_path.stem}.{os.getpid()}.tmp{output_path.suffix}")
+
+
+def _open_source(source: Union[bytes, str]) -> Tuple[Union[bytes, str], Optional[str]]:
+    """返回可解码的输入（内存数据或落盘文件路径）及嗅探出的格式"""
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source), sniff_format(source)
+    with open(source, 'rb') as f:
+        return source, sniff_format(f.read(16))
+
+
+def _as_file(data: Union[bytes, str]) -> Union[BytesIO, str]:
+    """Pillow需要文件对象，每次解码都包一个新的BytesIO"""
+    return BytesIO(data) if isinstance(data, bytes) else data
+
+
+def _get_reader(data: Union[bytes, str], fmt: Optional[str]):
+    """创建imageio读取器，内存数据没有扩展名，用嗅探出的格式作为提示"""
+    import imageio
+
+    if fmt:
+        return imageio.get_reader(data, format=f'.{fmt}')
+    return imageio.get_reader(data)
+
+
+def convert_with_report(source: Union[bytes, str], output_path: str, image_config: Dict,
+                        timeout: Optional[float] = None, check_passthrough: bool = True) -> Tuple[bool, Dict]:
+    """同convert，另外返回{'method': 成功的方案, 'seconds': 进程内耗时, 'etag': 输出文件的内容哈希, 'timed_out': 是否超时}
+
+    timeout为转换时限（秒），从转换进程开始执行时计时，不含在进程池中排队的时间；
+    耗时同样不含排队时间；内容哈希在转换进程中顺带算好，下载时直接用作ETag。
+    """
+    _report.clear()
+    started = time.perf_counter()
+    deadline = time.time() + timeout if timeout else None
+    success = convert(source, output_path, image_config, deadline, check_passthrough)
+    return success, {
+        'method': _report.get('method', 'none'),
+        'seconds': time.perf_counter() - started,
+        'etag': file_digest(output_path) if success else None,
+        'timed_out': not success and deadline is not None and time.time() > deadline
+    }
+
+
+def file_digest(source: Union[bytes, str]) -> str:
+    """内容哈希（数据或文件路径），用作下载文件的强ETag"""
+    if isinstance(source, (bytes, bytearray)):
+        return hashlib.sha1(source).hexdigest()
+    digest = hashlib.sha1()
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def convert(source: Union[bytes, str], output_path: str, image_config: Dict,
+            deadline: Optional[float] = None, check_passthrough: bool = True) -> bool:
+    """按output_path的扩展名转换为GIF/WebP/MP4/PNG（在转换进程中执行）
+
+    GIF走convert_to_gif；其他格式逐帧解码后交给对应的编码器，
+    同样先写临时文件再原子替换。
+    """
+    output_format = Path(output_path).suffix.lstrip('.').lower()
+    if output_format == 'gif':
+        return convert_to_gif(source, output_path, image_config, deadline, check_passthrough)
+    encoder = FRAME_ENCODERS.get(output_format)
+    if encoder is None:
+        logger.error(f"不支持的输出格式: {output_format}")
+        return False
+
+    output_path = Path(output_path)
+    temp_path = _temp_path(output_path)
+    try:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        data, fmt = _open_source(source)
+        frames = _prepared_frames(_iter_frames(data, fmt, image_config), image_config, deadline)
+        if not encoder(frames, temp_path, image_config):
+            logger.error(f"转换为{output_format}失败: 没有可用的帧")
+            return False
+        os.replace(temp_path, output_path)
+        logger.info(f"转换为{output_format}成功")
+        return True
+    except ConversionRejected as e:
+        logger.warning(f"拒绝转换: {e}")
+        return False
+    except TimeoutError:
+        logger.error(f"转换超时，已中止: {output_path}")
+        return False
+    except Exception as e:
+        logger.error(f"转换为{output_format}失败: {e}")
+        return False
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def convert_to_gif(source: Union[bytes, str], output_path: str, image_config: Dict,
+                   deadline: Optional[float] = None, check_passthrough: bool = True) -> bool:
+    """转换图片为GIF，保持动图效果（在转换进程中执行）
+
+    source为内存中的图片数据，或超过落盘阈值时的临时文件路径；
+    结果先写入同目录临时文件，成功后原子替换到output_path。
+    deadline为time.time()时间戳，逐帧检查，超时后中止转换。
+    已经符合要求的GIF直接原样保存；调用方已经探测过时传check_passthrough=False。
+    """
+    if check_passthrough and can_passthrough(probe(source), image_config):
+        logger.info("GIF已符合要求，原样保存")
+        _report['method'] = 'passthrough'
+        return passthrough(source, output_path)
+
+    output_path = Path(output_path)
+    temp_path = _temp_path(output_path)
+    try:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        data, fmt = _open_source(source)
+        success = False
+        conversion_methods = [
+            ('Pillow', _convert_with_pillow),
+            ('imageio', _convert_with_imageio)
+        ]
+
+        for method_name, method_func in conversion_methods:
+            try:
+                if method_func(data, fmt, temp_path, image_config, deadline):
+                    logger.info(f"{method_name}转换成功")
+                    _report['method'] = method_name
+                    success = True
+                    break
+            except (ConversionRejected, TimeoutError):
+                raise
+            except ImportError:
+                logger.warning(f"{method_name}未安装")
+            except Exception as e:
+                logger.warning(f"{method_name}转换失败: {e}")
+
+        if not success and fmt == 'gif':
+            success = _copy_source(data, temp_path)
+            _report['method'] = 'copy'
+
+        if success:
+            os.replace(temp_path, output_path)
+        else:
+            logger.error("所有转换方案都失败了")
+        return success
+
+    except ConversionRejected as e:
+        logger.warning(f"拒绝转换: {e}")
+        return False
+    except TimeoutError:
+        logger.error(f"转换超时，已中止: {output_path}")
+        return False
+    except Exception as e:
+        logger.error(f"转换失败: {e}")
+        return False
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def _copy_source(data: Union[bytes, str], output_path: Path) -> bool:
+    """GIF原样写入output_path（符合要求无需转换，或无法解码时的兜底）"""
+    try:
+        with open(output_path, 'wb') as out:
+            if isinstance(data, bytes):
+                out.write(data)
+            else:
+                with open(data, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+        logger.info("直接复制GIF文件成功")
+        return True
+    except Exception as e:
+        logger.error(f"复制GIF文件失败: {e}")
+        return False
+
+
+def _check_canvas(size: Tuple[int, int], image_config: Dict):
+    """限制单帧像素数，防止超大画布或解压炸弹占满内存"""
+    max_pixels = image_config.get('max_pixels', 4096 * 4096)
+    if size[0] * size[1] > max_pixels:
+        raise ConversionRejected(f"画布 {size[0]}x{size[1]} 超过像素上限 {max_pixels}")
+
+
+def get_resize_dimensions(width: int, height: int, max_size: int) -> tuple:
+    """计算调整后的尺寸，保持宽高比"""
+    if width <= max_size and height <= max_size:
+        return width, height
+
+    scale = min(max_size / width, max_size / height)
+    new_width = max(1, int(width * scale))
+    new_height = max(1, int(height * scale))
+
+    logger.info(f"尺寸压缩: {width}x{height} → {new_width}x{new_height}")
+    return new_width, new_height
+
+
+def _convert_with_pillow(data, fmt: Optional[str], output_path: Path, image_config: Dict, deadline: Optional[float]) -> bool:
+    """使用Pillow转换：源文件只解码一次，动图逐帧流式处理"""
+    from PIL import Image, ImageSequence
+
+    with Image.open(_as_file(data)) as img:
+        _check_canvas(img.size, image_config)
+        if getattr(img, 'is_animated', False):
+            def frames():
+                for frame in ImageSequence.Iterator(img):
+                    yield frame.convert('RGBA'), frame.info.get('duration')
+            return _encode_animation(frames, img.size, output_path, image_config, deadline)
+        return _write_static_gif(img, output_path, image_config)
+
+
+def _convert_with_imageio(data, fmt: Optional[str], output_path: Path, image_config: Dict, deadline: Optional[float]) -> bool:
+    """使用imageio转换（Pillow无法解码时的后备方案），同样逐帧处理"""
+    from PIL import Image
+
+    reader = _get_reader(data, fmt)
+    try:
+        frames = (Image.fromarray(frame).convert('RGBA') for frame in reader)
+        first = next(frames, None)
+        if first is None:
+            return False
+        _check_canvas(first.size, image_config)
+        second = next(frames, None)
+        if second is None:
+            return _write_static_gif(first, output_path, image_config)
+    finally:
+        reader.close()
+
+    def animation_frames():
+        frame_reader = _get_reader(data, fmt)
+        try:
+            for frame in frame_reader:
+                yield Image.fromarray(frame).convert('RGBA'), None
+        finally:
+            frame_reader.close()
+    return _encode_animation(animation_frames, first.size, output_path, image_config, deadline)
+
+
+def _write_static_gif(img, output_path: Path, image_config: Dict) -> bool:
+    """静图：透明部分铺白底后保存为GIF，颜色数按画质档位"""
+    from PIL import Image
+
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    original_width, original_height = img.size
+    new_width, new_height = get_resize_dimensions(original_width, original_height, image_config['max_image_size'])
+    if new_width != original_width or new_height != original_height:
+        img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    colors = QUALITY_COLORS.get(image_config.get('quality'), 256)
+    if colors < 256:
+        img = img.quantize(colors=colors)
+    img.save(output_path, 'GIF', optimize=True)
+    return True
+
+
+def _encode_animation(make_frames, size: Tuple[int, int], output_path: Path, image_config: Dict, deadline: Optional[float]) -> bool:
+    """编码动图；配置了字节预算时，超出预算就依次降低帧率、尺寸重新编码"""
+    budget = image_config.get('max_gif_bytes', 0)
+    steps = BUDGET_STEPS if budget else BUDGET_STEPS[:1]
+    for scale, frame_step in steps:
+        if not _write_animated_gif(make_frames(), size, output_path, image_config, deadline, scale, frame_step):
+            return False
+        output_size = output_path.stat().st_size
+        if not budget or output_size <= budget:
+            return True
+        logger.info(f"GIF大小 {output_size} 超过预算 {budget}（尺寸比例{scale}，抽帧间隔{frame_step}），继续压缩")
+    logger.warning(f"已压缩到最低档仍超过字节预算 {budget}，保留最后一次结果")
+    return True
+
+
+def _write_animated_gif(frames: Iterable, size: Tuple[int, int], output_path: Path, image_config: Dict,
+                        deadline: Optional[float], scale: float = 1.0, frame_step: int = 1) -> bool:
+    """动图：解码→缩放→编码逐帧完成，内存中只保留当前帧"""
+    from PIL import Image
+
+    max_frames = image_config.get('max_frames', 500)
+    new_width, new_height = get_resize_dimensions(size[0], size[1], image_config['max_image_size'])
+    if scale < 1:
+        new_width, new_height = max(1, int(new_width * scale)), max(1, int(new_height * scale))
+    default_duration = int(1000 / image_config['gif_fps'])
+    colors = QUALITY_COLORS.get(image_config.get('quality'), 256)
+
+    with open(output_path, 'wb') as fp:
+        encoder = AnimatedGifEncoder(fp, (new_width, new_height), colors)
+        for index, (frame, duration) in enumerate(frames):
+            if index >= max_frames:
+                logger.warning(f"帧数超过上限 {max_frames}，其余帧已丢弃")
+                break
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError()
+            duration = duration or default_duration
+            if index % frame_step:
+                encoder.extend(duration)
+                continue
+            if frame.size != (new_width, new_height):
+                frame = frame.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            encoder.add(frame, duration)
+        encoder.close()
+    return encoder.frames > 0
+
+
+class AnimatedGifEncoder:
+    """体积优化的动图编码器
+
+    - 保留源文件每帧的时长，相同的连续帧合并为一帧
+    - 每帧只编码相对当前画面变化的矩形区域，区域内未变化的像素写成透明
+    - 优先使用由首帧生成的全局调色板，色差过大的帧才带局部调色板
+    只缓存待写出的一帧和当前画面，内存占用与帧数无关。
+    """
+
+    # 映射到全局调色板后的平均色差上限
+    PALETTE_ERROR_LIMIT = 6
+    # 单个像素任一通道的色差上限：大块变化区域中的一小片新颜色拉不高平均值，需要逐像素检查
+    PALETTE_PIXEL_ERROR_LIMIT = 48
+
+    def __init__(self, fp: BinaryIO, size: Tuple[int, int], colors: int = 256):
+        self.fp = fp
+        self.size = size
+        self.colors = colors
+        self.writer: Optional[GifStreamWriter] = None
+        self.palette_image = None
+        self.transparency = 0
+        self.pending: Optional[list] = None
+        self.canvas = None
+
+    @property
+    def frames(self) -> int:
+        return self.writer.frames if self.writer else 0
+
+    def add(self, frame, duration: int):
+        """追加一帧RGBA图像，duration单位为毫秒"""
+        frame = _normalize_alpha(frame)
+        if self.pending is not None:
+            if _changed_pixels(self.pending[0], frame).getbbox() is None:
+                self.pending[1] += duration
+                return
+            self._emit(frame)
+        self.pending = [frame, duration]
+
+    def extend(self, duration: int):
+        """被抽掉的帧把时长并入上一帧，总播放时长不变"""
+        if self.pending is not None:
+            self.pending[1] += duration
+
+    def close(self):
+        if self.pending is not None:
+            self._emit(None)
+            self.pending = None
+        if self.writer is not None:
+            self.writer.close()
+
+    def _start(self, first_frame):
+        """用首帧生成全局调色板，最后一个颜色留给透明色"""
+        self.palette_image = first_frame.convert('RGB').quantize(colors=self.colors - 1)
+        palette = self.palette_image.getpalette()
+        self.transparency = len(palette) // 3
+        # 背景色指向透明色，首帧未覆盖的区域和disposal=2清除的区域都显示为透明
+        self.writer = GifStreamWriter(self.fp, self.size, palette + [0, 0, 0], background=self.transparency)
+
+    def _emit(self, next_frame):
+        """写出待定帧
+
+        只编码与当前画面不同的矩形区域。下一帧会露出本帧不透明的像素时，把这些像素
+        并入矩形并设置disposal=2，本帧显示结束后该矩形被清成透明。
+        """
+        from PIL import Image
+
+        frame, duration = self.pending
+        if self.writer is None:
+            # 首帧完整写出：部分解码器不会把首帧未覆盖的区域当作透明
+            self._start(frame)
+            self.canvas = Image.new('RGBA', self.size, (0, 0, 0, 0))
+            bbox = (0, 0) + self.size
+        else:
+            bbox = _changed_pixels(self.canvas, frame).getbbox() or (0, 0, 1, 1)
+        uncovered = _uncovered_bbox(frame, next_frame) if next_frame is not None else None
+        if uncovered:
+            bbox = (min(bbox[0], uncovered[0]), min(bbox[1], uncovered[1]),
+                    max(bbox[2], uncovered[2]), max(bbox[3], uncovered[3]))
+
+        patch = frame.crop(bbox)
+        unchanged = _changed_pixels(self.canvas.crop(bbox), patch).point(lambda v: 255 if v == 0 else 0)
+        patch.paste((0, 0, 0, 0), (0, 0) + patch.size, unchanged)
+
+        # disposal=2时总是声明透明色，部分解码器按透明色而非背景色清除
+        indexed, transparency, palette = self._quantize(patch, bool(uncovered))
+        self.writer.write_frame(indexed, duration, bbox[:2], 2 if uncovered else 1, transparency, palette)
+        self.canvas = frame
+        if uncovered:
+            self.canvas = frame.copy()
+            self.canvas.paste((0, 0, 0, 0), bbox)
+
+    def _quantize(self, patch, need_transparency: bool = False):
+        """优先映射到全局调色板，平均色差或任一像素的色差超限时改用局部调色板"""
+        from PIL import Image, ImageChops, ImageStat
+
+        rgb = patch.convert('RGB')
+        transparent = ImageChops.invert(patch.getchannel('A'))
+        has_transparency = need_transparency or transparent.getbbox() is not None
+
+        indexed = rgb.quantize(palette=self.palette_image, dither=Image.Dither.NONE)
+        error = ImageChops.difference(rgb, indexed.convert('RGB'))
+        if has_transparency:
+            error.paste((0, 0, 0), (0, 0) + error.size, transparent)
+        # 每个像素取三个通道中最大的色差
+        worst = ImageChops.lighter(ImageChops.lighter(*error.split()[:2]), error.getchannel('B'))
+        if (max(ImageStat.Stat(error).mean) <= self.PALETTE_ERROR_LIMIT
+                and worst.getextrema()[1] <= self.PALETTE_PIXEL_ERROR_LIMIT):
+            if has_transparency:
+                indexed.paste(self.transparency, (0, 0) + indexed.size, transparent)
+                return indexed, self.transparency, None
+            return indexed, None, None
+
+        indexed = rgb.quantize(colors=self.colors - 1 if has_transparency else self.colors)
+        palette = indexed.getpalette()
+        if not has_transparency:
+            return indexed, None, palette
+        transparency = len(palette) // 3
+        palette = palette + [0, 0, 0]
+        indexed.putpalette(palette)
+        indexed.paste(transparency, (0, 0) + indexed.size, transparent)
+        return indexed, transparency, palette
+
+
+def _normalize_alpha(frame):
+    """透明度二值化（GIF只有全透明和不透明），全透明像素统一为(0,0,0,0)，便于逐帧比较"""
+    from PIL import Image
+
+    alpha = frame.getchannel('A')
+    low, _ = alpha.getextrema()
+    if low == 255:
+        return frame
+    opaque = frame.copy()
+    opaque.putalpha(255)
+    if low >= 128:
+        return opaque
+    clean = Image.new('RGBA', frame.size, (0, 0, 0, 0))
+    clean.paste(opaque, (0, 0), alpha.point(lambda a: 255 if a >= 128 else 0))
+    return clean
+
+
+def _uncovered_bbox(frame, next_frame) -> Optional[Tuple[int, int, int, int]]:
+    """下一帧的透明像素落在本帧不透明区域上的范围，没有时返回None"""
+    from PIL import ImageChops
+
+    next_alpha = next_frame.getchannel('A')
+    if next_alpha.getextrema()[0] == 255:
+        return None
+    return ImageChops.multiply(frame.getchannel('A'), ImageChops.invert(next_alpha)).getbbox()
+
+
+def _changed_pixels(before, after):
+    """两幅同尺寸RGBA图像逐像素比较，返回L模式图像，非0处为有变化的像素
+
+    RGBA图像的getbbox只看透明通道，所以先把四个通道的差异合并成单通道再比较。
+    """
+    from PIL import ImageChops
+
+    red, green, blue, alpha = ImageChops.difference(before, after).split()
+    return ImageChops.lighter(ImageChops.lighter(red, green), ImageChops.lighter(blue, alpha))
+
+
+def _palette_table(palette: list) -> Tuple[bytes, int]:
+    """调色板补齐到2的幂，返回颜色表字节和大小位"""
+    count = max(1, len(palette) // 3)
+    bits = max(0, (count - 1).bit_length() - 1)
+    table = bytes(palette[:768])
+    return table + b'\x00' * (3 * (2 << bits) - len(table)), bits
+
+
+class GifStreamWriter:
+    """逐帧写出GIF文件
+
+    每帧编码后立即写入，不在内存中累积帧列表。单帧LZW编码借用Pillow
+    保存单帧GIF的结果，再按需要配上全局或局部调色板追加到输出文件中。
+    """
+
+    def __init__(self, fp: BinaryIO, size: Tuple[int, int], palette: Optional[list] = None,
+                 background: int = 0, loop: int = 0):
+        self.fp = fp
+        self.size = size
+        self.frames = 0
+        flags = 0
+        table = b''
+        if palette:
+            table, bits = _palette_table(palette)
+            flags = 0x80 | 0x70 | bits
+        fp.write(b'GIF89a' + struct.pack('<HHBBB', size[0], size[1], flags, background, 0) + table)
+        fp.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', loop) + b'\x00')
+
+    def write_frame(self, indexed, duration: int, offset: Tuple[int, int] = (0, 0), disposal: int = 2,
+                    transparency: Optional[int] = None, palette: Optional[list] = None):
+        """写入一帧调色板图像；palette为None时使用全局调色板，duration单位为毫秒"""
+        buffer = BytesIO()
+        indexed.save(buffer, 'GIF', optimize=False, interlace=False)
+        image_data = _split_single_frame(buffer.getvalue())
+
+        flags = 0
+        table = b''
+        if palette is not None:
+            table, bits = _palette_table(palette)
+            flags = 0x80 | bits
+        packed = (disposal << 2) | (1 if transparency is not None else 0)
+        self.fp.write(b'!\xf9\x04' + struct.pack('<BHBB', packed, max(2, round(duration / 10)), transparency or 0, 0))
+        self.fp.write(b',' + struct.pack('<HHHHB', offset[0], offset[1], indexed.size[0], indexed.size[1], flags) + table)
+        self.fp.write(image_data)
+        self.frames += 1
+
+    def close(self):
+        self.fp.write(b';')
+
+
+def _split_single_frame(data: bytes) -> bytes:
+    """从Pillow保存的单帧GIF中取出LZW图像数据"""
+    packed = data[10]
+    pos = 13
+    if packed & 0x80:
+        pos += 3 * (2 << (packed & 0x07))
+    while data[pos] == 0x21:
+        pos += 2
+        while data[pos]:
+            pos += data[pos] + 1
+        pos += 1
+    if data[pos] != 0x2c:
+        raise ValueError('无效的GIF帧数据')
+    flags = data[pos + 9]
+    pos += 10
+    if flags & 0x80:
+        pos += 3 * (2 << (flags & 0x07))
+    start = pos
+    pos += 1
+    while data[pos]:
+        pos += data[pos] + 1
+    pos += 1
+    return data[start:pos]
+
+
+def _iter_frames(data: Union[bytes, str], fmt: Optional[str], image_config: Dict) -> Iterator[Tuple]:
+    """逐帧解码源图，产出(RGBA帧, 时长毫秒或None)；Pillow无法打开时改用imageio"""
+    from PIL import Image, ImageSequence
+
+    try:
+        img = Image.open(_as_file(data))
+    except Exception as e:
+        logger.warning(f"Pillow无法打开，改用imageio: {e}")
+        img = None
+    if img is not None:
+        _report['method'] = 'Pillow'
+        with img:
+            _check_canvas(img.size, image_config)
+            for frame in ImageSequence.Iterator(img):
+                yield frame.convert('RGBA'), frame.info.get('duration')
+        return
+
+    reader = _get_reader(data, fmt)
+    _report['method'] = 'imageio'
+    try:
+        for index, frame in enumerate(reader):
+            frame = Image.fromarray(frame).convert('RGBA')
+            if index == 0:
+                _check_canvas(frame.size, image_config)
+            yield frame, None
+    finally:
+        reader.close()
+
+
+def _prepared_frames(frames: Iterable, image_config: Dict, deadline: Optional[float]) -> Iterator[Tuple]:
+    """逐帧预处理：帧数上限、超时检查、缩放到max_image_size、补齐缺失的帧时长"""
+    from PIL import Image
+
+    max_frames = image_config.get('max_frames', 500)
+    default_duration = int(1000 / image_config['gif_fps'])
+    target = None
+    for index, (frame, duration) in enumerate(frames):
+        if index >= max_frames:
+            logger.warning(f"帧数超过上限 {max_frames}，其余帧已丢弃")
+            break
+        if deadline is not None and time.time() > deadline:
+            raise TimeoutError()
+        if target is None:
+            target = get_resize_dimensions(frame.size[0], frame.size[1], image_config['max_image_size'])
+        if frame.size != target:
+            frame = frame.resize(target, Image.Resampling.LANCZOS)
+        yield frame, duration or default_duration
+
+
+def _write_png(frames: Iterator[Tuple], output_path: Path, image_config: Dict) -> bool:
+    """静态PNG：只取首帧，保留透明通道"""
+    frame, _ = next(frames, (None, None))
+    if frame is None:
+        return False
+    frame.save(output_path, 'PNG', optimize=True)
+    return True
+
+
+def _write_webp(frames: Iterator[Tuple], output_path: Path, image_config: Dict) -> bool:
+    """WebP：保留帧时长和透明度，相同的连续帧合并
+
+    Pillow的动图WebP编码需要一次拿到全部帧，这里收集的是缩放后的帧，
+    数量受max_frames限制。
+    """
+    collected = []
+    durations = []
+    for frame, duration in frames:
+        if collected and _changed_pixels(collected[-1], frame).getbbox() is None:
+            durations[-1] += duration
+            continue
+        collected.append(frame)
+        durations.append(duration)
+    if not collected:
+        return False
+
+    quality = WEBP_QUALITY.get(image_config.get('quality'), 90)
+    if len(collected) == 1:
+        collected[0].save(output_path, 'WEBP', quality=quality, method=4)
+    else:
+        collected[0].save(
+            output_path, 'WEBP', save_all=True, append_images=collected[1:],
+            duration=durations, loop=0, quality=quality, method=4
+        )
+    return True
+
+
+def _write_mp4(frames: Iterator[Tuple], output_path: Path, image_config: Dict) -> bool:
+    """MP4（H.264）：逐帧写入ffmpeg，透明部分铺白底
+
+    视频是固定帧率（gif_fps），按源帧时长把每帧重复到对应的时间点，
+    重复帧在H.264中几乎不占空间。yuv420p要求宽高为偶数，奇数边补一像素白边。
+    """
+    import numpy
+    import imageio
+    from PIL import Image
+
+    fps = image_config['gif_fps']
+    writer = None
+    clock = 0
+    emitted = 0
+    try:
+        for frame, duration in frames:
+            width, height = frame.size
+            canvas = Image.new('RGB', (width + width % 2, height + height % 2), (255, 255, 255))
+            canvas.paste(frame, (0, 0), frame.getchannel('A'))
+            if writer is None:
+                writer = imageio.get_writer(
+                    str(output_path), format='FFMPEG', mode='I', fps=fps, codec='libx264',
+                    pixelformat='yuv420p', macro_block_size=1,
+                    output_params=['-movflags', '+faststart']
+                )
+            pixels = numpy.asarray(canvas)
+            clock += duration
+            while emitted * 1000 / fps < clock:
+                writer.append_data(pixels)
+                emitted += 1
+    finally:
+        if writer is not None:
+            writer.close()
+    return emitted > 0
+
+
+# 非GIF输出格式对应的编码器，参数为(逐帧迭代器, 输出路径, 图片配置)
+FRAME_ENCODERS = {
+    'webp': _write_webp,
+    'mp4': _write_mp4,
+    'png': _write_png
+}
@@ -1,24 +1,54 @@
 import os
-import sys
 import json
 import time
 import requests
 import asyncio
 import aiohttp
-import aiofiles
 import random
 from pathlib import Path
-from urllib.parse import urlparse, unquote
 import logging
-from typing import List, Dict, Optional, Tuple
-import subprocess
+from typing import AsyncIterator, List, Dict, Optional, Tuple, Union
 import tempfile
-import shutil
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import converter
+import metrics
+import supervisor
+from admission import Rejected
+from cache import CursorStore, FileLock, ResponseCache, SingleFlight
+from store import FULL_TIER, EmojiStore, tier_image_configs
+from upstream import UpstreamHealth
 from config import DOUYIN_CONFIG, SERVER_CONFIG, PERFORMANCE_CONFIG, IMAGE_CONFIG
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# 查询热度最多记录的条数，超出后只保留最热门的一部分
+MAX_TRACKED_QUERIES = 10000
+
+# 下载目录中允许对外提供的文件类型，索引数据库、锁文件等不对外暴露
+SERVABLE_SUFFIXES = {f'.{fmt}' for fmt in converter.OUTPUT_FORMATS}
+
+# 抖音接口的超时（秒），有足够的延迟样本后按近期延迟缩短
+API_TIMEOUT = 30
+
+# 下载请求头方案：(名称, 请求头, 连接超时, 总超时)，前一个失败时依次尝试下一个
+DOWNLOAD_PROFILES = [
+    ('标准', {
+        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36',
+        'Accept': '*/*',
+        'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8'
+    }, 10, 30),
+    ('激进', {
+        'User-Agent': 'curl/7.68.0',
+        'Accept': '*/*'
+    }, 15, 45),
+    ('最简', {}, 20, 60),
+]
+
 class EmoticonAPI:
     def __init__(self):
         self.config = {
@@ -32,186 +62,687 @@ class EmoticonAPI:
             'image': IMAGE_CONFIG
         }
         Path(self.config['download_dir']).mkdir(exist_ok=True)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        performance = self.config['performance']
+        # 多进程模式下分页cursor、上游响应缓存和仓库索引都经SQLite在进程间共享，转换加文件锁
+        self._worker_count = supervisor.worker_count()
+        shared = self._worker_count > 1
+        download_dir = Path(self.config['download_dir'])
+        self._file_lock = shared or performance.get('conversion_file_lock', False)
+        self._cursor_store = CursorStore(
+            max_entries=performance.get('cursor_store_size', 10000),
+            max_age=performance.get('cursor_max_age', 3600),
+            db_path=performance.get('cursor_db') or (str(download_dir / 'cursors.db') if shared else None)
+        )
+        self._background_tasks = set()
+        self._store = EmojiStore(
+            self.config['download_dir'],
+            max_bytes=performance.get('store_max_bytes', 0),
+            db_path=performance.get('store_db'),
+            shared=shared
+        )
+        self._conversions = 0
+        self._coalesced_conversions = 0
+        self._deferred_items = 0
+        self._passthroughs = 0
+        self._conversion_flight = SingleFlight(cancel_abandoned=True)
+        self._pipeline_tasks: List[asyncio.Task] = []
+        self._download_queue: Optional[asyncio.Queue] = None
+        self._convert_queue: Optional[asyncio.Queue] = None
+        self._prefetching = set()
+        self._response_cache = ResponseCache(
+            ttl=performance.get('response_cache_ttl', 60) if performance.get('enable_cache', True) else 0,
+            max_entries=performance.get('response_cache_size', 1000),
+            db_path=performance.get('response_cache_db') or (str(download_dir / 'responses.db') if shared else None)
+        )
+        self._executor_workers = 0
+        self._output_formats = converter.available_formats()
+        self._image_configs = tier_image_configs(self.config['image'])
+        self._config_fingerprints = {
+            tier: converter.config_fingerprint(image_config) for tier, image_config in self._image_configs.items()
+        }
+        self._upstreams = UpstreamHealth(performance)
+        self._live_requests = 0
+        self._query_counts: Counter = Counter()
     
-    async def process_request(self, ac: str, wxid: str, start: int = 0, limit: int = 40, keyword: str = '') -> Dict:
-        """处理API请求"""
+    async def process_request(self, ac: str, wxid: str, start: int = 0, limit: int = 40, keyword: str = '',
+                              output_format: str = 'gif', size_tier: Optional[str] = None,
+                              deadline: Optional[float] = None) -> Dict:
+        """处理API请求
+
+        output_format为输出格式（gif/webp/mp4/png），默认gif；
+        size_tier为列表使用的尺寸档位，默认取IMAGE_CONFIG['list_tier']，
+        非full档位的条目同时带上原尺寸的full_url，原尺寸在首次访问时再生成；
+        deadline为本次请求的响应时限（秒），默认取PERFORMANCE_CONFIG['response_deadline']，0表示不限制。
+        到时限时只返回已经就绪的表情包，其余在后台继续转换，pending为未返回的数量。
+        """
         try:
             if not ac or not wxid:
                 return {'msg': '缺少必要参数', 'code': 400}
             
-            if wxid not in self.config['allowed_wxids']:
-                return {'msg': 'wxid不在允许列表中', 'code': 403}
+            error, output_format, size_tier = self.check_request(wxid, output_format, size_tier)
+            if error:
+                return error
+            return await self._query(ac, keyword, start, limit, output_format, size_tier, self._expires(deadline))
+            
+        except Exception as e:
+            logger.error(f"处理请求失败: {e}")
+            return {'msg': f'处理失败: {str(e)}', 'code': 500}
+    
+    def check_request(self, wxid: str, output_format: str = 'gif',
+                      size_tier: Optional[str] = None) -> Tuple[Optional[Dict], str, str]:
+        """检查wxid、格式和尺寸档位，返回(错误响应或None, 实际使用的格式, 尺寸档位)"""
+        if wxid not in self.config['allowed_wxids']:
+            return {'msg': 'wxid不在允许列表中', 'code': 403}, output_format, size_tier
+        
+        output_format = (output_format or 'gif').lower()
+        if output_format not in converter.OUTPUT_FORMATS:
+            return {'msg': f'不支持的格式: {output_format}', 'code': 400}, output_format, size_tier
+        if output_format not in self._output_formats:
+            logger.warning(f"当前环境无法输出{output_format}，改用gif")
+            output_format = 'gif'
+        size_tier = size_tier or self.config['image'].get('list_tier', FULL_TIER)
+        if size_tier not in self._image_configs:
+            return {'msg': f'不支持的尺寸: {size_tier}', 'code': 400}, output_format, size_tier
+        return None, output_format, size_tier
+    
+    def _expires(self, deadline: Optional[float]) -> Optional[float]:
+        """响应时限（秒）换算为事件循环时间的截止时刻，不限制时返回None"""
+        if deadline is None:
+            deadline = self.config['performance'].get('response_deadline', 15)
+        # 时限从收到请求开始计算，包括请求上游的时间
+        return asyncio.get_running_loop().time() + deadline if deadline and deadline > 0 else None
+    
+    async def _query(self, ac: str, keyword: str, start: int, limit: int, output_format: str, size_tier: str,
+                     expires: Optional[float], prefetch: bool = True) -> Dict:
+        """查询一页表情包并下载转换，格式和尺寸档位已经过check_request检查"""
+        self._live_requests += 1
+        try:
             emojis = await self._call_douyin_api(ac, keyword, start, limit)
 
             if not emojis:
                 return {'msg': '获取表情包失败', 'code': 500}
+            if start == 0:
+                self._record_query(ac, keyword, output_format, size_tier)
             start_time = time.time()
-            converted_items = await self._download_and_convert_emojis(emojis, keyword)
-            process_time = time.time() - start_time
+            converted_items, pending = await self._prepare_items(emojis, keyword, output_format, size_tier, expires)
+            # 本页处理完才预取下一页：客户端中途断开时请求被取消，不会留下预取任务继续下载转换
+            if prefetch:
+                self._schedule_prefetch(ac, keyword, start, limit, output_format, size_tier)
+        finally:
+            self._live_requests -= 1
+        process_time = time.time() - start_time
+        if pending:
+            logger.info(f"处理完成，耗时: {process_time:.2f}秒，{pending}个表情包超过时限，在后台继续转换")
+        else:
             logger.info(f"处理完成，耗时: {process_time:.2f}秒")
-            
-            return {
-                'msg': '请求成功',
-                'code': 200,
-                'items': converted_items,
-                'format': 'gif',
-                'original_count': len(emojis),
-                'process_time': f"{process_time:.2f}s"
-            }
-            
-        except Exception as e:
-            logger.error(f"处理请求失败: {e}")
-            return {'msg': f'处理失败: {str(e)}', 'code': 500}
+        
+        return {
+            'msg': '请求成功',
+            'code': 200,
+            'items': converted_items,
+            'format': output_format,
+            'size': size_tier,
+            'original_count': len(emojis),
+            'pending': pending,
+            'process_time': f"{process_time:.2f}s"
+        }
+    
+    async def iter_batch(self, queries: List[Dict], output_format: str, size_tier: str,
+                         deadline: Optional[float] = None, admit=None) -> AsyncIterator[Tuple[int, Dict]]:
+        """批量查询：各查询并发请求上游和下载转换，按完成顺序逐个产出(序号, 结果)
+
+        queries中每项为{ac, keyword, start, limit}，格式和尺寸档位需先经过check_request检查。
+        完全相同的查询只执行一次；同一个表情包出现在多个查询结果中时，经_conversion_flight
+        合并为一次下载转换，所有查询共用同一条下载→转换流水线。时限对整批查询统一计算。
+        批量查询不触发下一页预取。迭代被中止（客户端断开）时取消尚未完成的查询。
+        admit(ac, keyword, start)返回准入的异步上下文管理器，每个查询分别准入（与单个请求同样
+        计入限速和并发名额），被拒绝的查询返回对应的状态码和retry_after。
+        """
+        expires = self._expires(deadline)
+        tasks: Dict[asyncio.Future, List[int]] = {}
+        by_query: Dict[Tuple, asyncio.Future] = {}
+        for index, query in enumerate(queries):
+            try:
+                ac = str(query.get('ac') or '')
+                keyword = str(query.get('keyword') or '')
+                start = int(query.get('start', 0))
+                limit = int(query.get('limit', 40))
+            except (AttributeError, TypeError, ValueError):
+                yield index, {'msg': '查询参数无效', 'code': 400}
+                continue
+            if not ac:
+                yield index, {'msg': '缺少必要参数', 'code': 400}
+                continue
+            key = (ac, keyword, start, limit)
+            task = by_query.get(key)
+            if task is None:
+                task = by_query[key] = asyncio.ensure_future(
+                    self._admitted_query(admit, ac, keyword, start, limit, output_format, size_tier, expires)
+                )
+                tasks[task] = []
+            tasks[task].append(index)
+        
+        unfinished = set(tasks)
+        try:
+            while unfinished:
+                done, unfinished = await asyncio.wait(unfinished, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        logger.error(f"批量查询失败: {task.exception()}")
+                        result = {'msg': f'处理失败: {task.exception()}', 'code': 500}
+                    else:
+                        result = task.result()
+                    for index in tasks[task]:
+                        yield index, result
+        finally:
+            for task in unfinished:
+                task.cancel()
+    
+    async def _admitted_query(self, admit, ac: str, keyword: str, start: int, limit: int,
+                              output_format: str, size_tier: str, expires: Optional[float]) -> Dict:
+        """批量查询中的一个查询：获得准入后执行，不预取下一页"""
+        if admit is None:
+            return await self._query(ac, keyword, start, limit, output_format, size_tier, expires, prefetch=False)
+        try:
+            async with admit(ac, keyword, start):
+                return await self._query(ac, keyword, start, limit, output_format, size_tier, expires, prefetch=False)
+        except Rejected as e:
+            return {'msg': e.msg, 'code': e.status, 'retry_after': e.retry_after}
+    
+    def _record_query(self, ac: str, keyword: str, output_format: str, size_tier: str):
+        """记录第一页查询的热度，供缓存预热挑选热门查询"""
+        search_keyword = keyword if ac == 'search' else ""
+        self._query_counts[(ac, search_keyword, output_format, size_tier)] += 1
+        if len(self._query_counts) > MAX_TRACKED_QUERIES:
+            self._query_counts = Counter(dict(self._query_counts.most_common(MAX_TRACKED_QUERIES // 10)))
+    
+    def popular_queries(self, n: int) -> List[Tuple[str, str, str, str]]:
+        """最热门的n个查询(ac, keyword, 格式, 尺寸档位)"""
+        return [query for query, _ in self._query_counts.most_common(n)]
+    
+    def decay_popularity(self):
+        """热度计数减半，长期没有请求的查询逐渐退出热门"""
+        self._query_counts = Counter({query: count // 2 for query, count in self._query_counts.items() if count > 1})
+    
+    def default_variant(self) -> Tuple[str, str]:
+        """不带参数请求时的(格式, 尺寸档位)"""
+        return 'gif', self.config['image'].get('list_tier', FULL_TIER)
+    
+    def is_busy(self) -> bool:
+        """是否有线上请求、排队或进行中的下载转换任务"""
+        queued = sum(queue.qsize() for queue in (self._download_queue, self._convert_queue) if queue is not None)
+        return self._live_requests > 0 or queued > 0 or len(self._conversion_flight) > 0
+    
+    async def fetch_page(self, ac: str, keyword: str, start: int, limit: int) -> List[Dict]:
+        """获取一页表情包列表（经过响应缓存）"""
+        return await self._call_douyin_api(ac, keyword, start, limit)
+    
+    async def warm_items(self, emojis: List[Dict], keyword: str, output_format: str, size_tier: str) -> List[Dict]:
+        """把表情包转换进仓库，懒转换模式下同样直接转换"""
+        items, _ = await self._download_and_convert_emojis(emojis, keyword, output_format, size_tier)
+        return items
+    
+    def _page_key(self, ac: str, keyword: str, start: int) -> Tuple[str, str, str]:
+        """上游响应缓存的key(ac, 搜索关键词, cursor)：翻页时优先使用记录的cursor"""
+        search_keyword = keyword if ac == 'search' else ""
+        cursor = "0" if start == 0 else str(start)
+        if start > 0:
+            cached_cursor = self._cursor_store.get(ac, search_keyword, start)
+            if cached_cursor:
+                cursor = cached_cursor
+        return ac, search_keyword, cursor
+    
+    def is_cheap(self, ac: str, keyword: str, start: int) -> bool:
+        """第一页，或上游响应已缓存的请求，准入排队时优先处理"""
+        return start == 0 or self._response_cache.get(self._page_key(ac, keyword, start)) is not None
     
     async def _call_douyin_api(self, ac: str, keyword: str, start: int, limit: int) -> List[Dict]:
         """调用抖音API获取表情包列表"""
         try:
-            if start == 0:
-                cursor = "0"
-            else:
-                cursor = str(start)
+            _, search_keyword, cursor = self._page_key(ac, keyword, start)
             logger.info(f"分页参数: start={start}, limit={limit}, cursor={cursor}")
             
-            if start > 0 and hasattr(self, '_pagination_cache') and keyword in self._pagination_cache:
-                cached_cursor = self._pagination_cache[keyword].get(str(start))
-                if cached_cursor:
-                    cursor = cached_cursor
-                    logger.info(f"使用缓存的分页cursor: {cursor}")
+            page = await self._response_cache.get_or_fetch(
+                (ac, search_keyword, cursor),
+                lambda: self._fetch_sticker_page(search_keyword, cursor)
+            )
+            if not page:
+                return []
             
-            params = {
-                "device_platform": "webapp",
-                "aid": "1128",
-                "keyword": keyword if ac == 'search' else "",
-                "cursor": cursor,
-                "msToken": self._get_ms_token()
-            }
+            sticker_list = page['sticker_list']
+            if sticker_list:
+                next_cursor = page['next_cursor']
+                has_more = page['has_more']
+                next_start = start + limit
+                next_page = next_start // limit + 1
+                
+                if has_more and next_cursor:
+                    self._cursor_store.set(ac, search_keyword, next_start, str(next_cursor))
+                    logger.info(f"缓存分页信息: 第{next_page}页(start={next_start})使用cursor={next_cursor}")
+                
+                logger.info(f"成功获取 {len(sticker_list)} 个表情包，下一页cursor: {next_cursor}, 还有更多: {has_more}")
+            else:
+                logger.warning("表情包列表为空")
+            return sticker_list
+                    
+        except Exception as e:
+            logger.error(f"调用抖音API失败: {e}")
+            return []
+    
+    async def _fetch_sticker_page(self, keyword: str, cursor: str) -> Optional[Dict]:
+        """请求一页抖音表情包数据并记录耗时，失败时返回None（不进入缓存）
+
+        抖音接口连续失败时熔断，冷却期内直接返回None，不再等待超时；连接和读取超时按近期延迟自适应。
+        """
+        health = self._upstreams.for_url(self.config['douyin_api_url'])
+        if not health.allow():
+            health.skipped += 1
+            metrics.CIRCUIT_SKIPS.inc(target='api')
+            logger.warning(f"抖音接口熔断中，跳过请求: {health.host}")
+            return None
+        started = time.perf_counter()
+        page = None
+        try:
+            page = await self._request_sticker_page(keyword, cursor, health.timeout(API_TIMEOUT))
+        except asyncio.CancelledError:
+            health.release()
+            raise
+        except Exception:
+            health.failure()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.UPSTREAM_SECONDS.observe(elapsed, result='ok' if page else 'error')
+        # 接口返回错误或无法识别的数据同样计为失败
+        if page:
+            health.success(elapsed)
+        else:
+            health.failure()
+        return page
+    
+    async def _request_sticker_page(self, keyword: str, cursor: str, read_timeout: float = API_TIMEOUT) -> Optional[Dict]:
+        """read_timeout限制建立连接和等待数据的时间，整个请求的总超时为API_TIMEOUT"""
+        params = {
+            "device_platform": "webapp",
+            "aid": "1128",
+            "keyword": keyword,
+            "cursor": cursor,
+            "msToken": self._get_ms_token()
+        }
+        
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36",
+            "Accept": "application/json, text/plain, */*",
+            "Referer": "https://www.douyin.com/",
+            "Cookie": self.config['cookie']
+        }
+        
+        logger.info(f"调用抖音API: {self.config['douyin_api_url']}")
+        logger.info(f"参数: {params}")
+        
+        session = self._get_session()
+        async with session.get(
+            self.config['douyin_api_url'],
+            params=params,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(total=API_TIMEOUT, sock_connect=read_timeout, sock_read=read_timeout)
+        ) as response:
+            if response.status != 200:
+                logger.error(f"抖音API请求失败: {response.status}")
+                return None
             
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36",
-                "Accept": "application/json, text/plain, */*",
-                "Referer": "https://www.douyin.com/",
-                "Cookie": self.config['cookie']
-            }
+            content_encoding = response.headers.get('content-encoding', '').lower()
+            logger.info(f"抖音API返回Content-Type: {response.headers.get('Content-Type', '')}")
+            logger.info(f"Content-Encoding: {content_encoding}")
             
-            logger.info(f"调用抖音API: {self.config['douyin_api_url']}")
-            logger.info(f"参数: {params}")
+            try:
+                data = await response.json()
+                logger.info(f"抖音API返回数据: {json.dumps(data, ensure_ascii=False)[:200]}...")
+            except Exception as e:
+                logger.error(f"解析抖音API响应失败: {e}")
+                try:
+                    text_content = await response.text()
+                    logger.error(f"原始响应内容: {text_content[:500]}")
+                except:
+                    pass
+                return None
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    self.config['douyin_api_url'],
-                    params=params,
-                    headers=headers,
-                    timeout=30
-                ) as response:
-                    if response.status == 200:
-                        content_encoding = response.headers.get('content-encoding', '').lower()
-                        logger.info(f"抖音API返回Content-Type: {response.headers.get('Content-Type', '')}")
-                        logger.info(f"Content-Encoding: {content_encoding}")
-                        
-                        try:
-                            data = await response.json()
-                            logger.info(f"抖音API返回数据: {json.dumps(data, ensure_ascii=False)[:200]}...")
-                            
-                            if 'emoticon_data' in data and 'sticker_list' in data['emoticon_data']:
-                                sticker_list = data['emoticon_data']['sticker_list']
-                                if sticker_list:
-                                    if not hasattr(self, '_pagination_cache'):
-                                        self._pagination_cache = {}
-                                    if keyword not in self._pagination_cache:
-                                        self._pagination_cache[keyword] = {}
-                                    next_cursor = data['emoticon_data'].get('next_cursor', '0')
-                                    has_more = data['emoticon_data'].get('has_more', False)
-                                    current_page = start // limit + 1
-                                    next_page = current_page + 1
-                                    next_start = next_page * limit
-                                    
-                                    if has_more and next_cursor:
-                                        self._pagination_cache[keyword][str(next_start)] = str(next_cursor)
-                                        logger.info(f"缓存分页信息: 第{next_page}页(start={next_start})使用cursor={next_cursor}")
-                                    
-                                    logger.info(f"成功获取 {len(sticker_list)} 个表情包，下一页cursor: {next_cursor}, 还有更多: {has_more}")
-                                    return sticker_list
-                                else:
-                                    logger.warning("表情包列表为空")
-                                    return []
-                            else:
-                                logger.warning(f"未找到表情包数据，完整响应: {json.dumps(data, ensure_ascii=False)[:500]}")
-                                return []
-                                
-                        except Exception as e:
-                            logger.error(f"解析抖音API响应失败: {e}")
-                            try:
-                                text_content = await response.text()
-                                logger.error(f"原始响应内容: {text_content[:500]}")
-                            except:
-                                pass
-                            return []
-                    else:
-                        logger.error(f"抖音API请求失败: {response.status}")
-                        return []
-                        
+            if 'emoticon_data' in data and 'sticker_list' in data['emoticon_data']:
+                emoticon_data = data['emoticon_data']
+                return {
+                    'sticker_list': emoticon_data['sticker_list'] or [],
+                    'next_cursor': emoticon_data.get('next_cursor', '0'),
+                    'has_more': emoticon_data.get('has_more', False)
+                }
+            logger.warning(f"未找到表情包数据，完整响应: {json.dumps(data, ensure_ascii=False)[:500]}")
+            return None
+    
+    def _schedule_prefetch(self, ac: str, keyword: str, start: int, limit: int,
+                           output_format: str = 'gif', size_tier: str = FULL_TIER):
+        """返回第N页时，后台预取第N+1页的列表并提前下载转换"""
+        if not self.config['performance'].get('enable_prefetch', True):
+            return
+        next_start = start + limit
+        search_keyword = keyword if ac == 'search' else ""
+        key = (ac, search_keyword, next_start, limit, output_format, size_tier)
+        if key in self._prefetching or not self._cursor_store.get(ac, search_keyword, next_start):
+            return
+        self._prefetching.add(key)
+        self._spawn_background(self._prefetch_page(ac, keyword, next_start, limit, output_format, size_tier), key)
+    
+    def _spawn_background(self, coro, prefetch_key=None) -> asyncio.Task:
+        """启动后台任务并保留引用，避免被垃圾回收"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        
+        def done(t):
+            self._background_tasks.discard(t)
+            if prefetch_key is not None:
+                self._prefetching.discard(prefetch_key)
+        task.add_done_callback(done)
+        return task
+    
+    async def _prefetch_page(self, ac: str, keyword: str, start: int, limit: int,
+                             output_format: str = 'gif', size_tier: str = FULL_TIER):
+        """预取一页：列表进入响应缓存，表情包进入下载目录"""
+        try:
+            emojis = await self._call_douyin_api(ac, keyword, start, limit)
+            if emojis:
+                logger.info(f"预取下一页: keyword={keyword}, start={start}, 共{len(emojis)}个")
+                await self._prepare_items(emojis, keyword, output_format, size_tier)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"调用抖音API失败: {e}")
-            return []
+            logger.warning(f"预取下一页失败: {e}")
+    
+    async def _prepare_items(self, emojis: List[Dict], keyword: str, output_format: str = 'gif',
+                             size_tier: str = FULL_TIER, expires: Optional[float] = None) -> Tuple[List[Dict], int]:
+        """生成返回给客户端的表情包列表和未就绪的数量：懒转换模式下只登记来源，首次访问时再转换"""
+        if self.config['performance'].get('lazy_conversion', False):
+            return self._lazy_items(emojis, output_format, size_tier), 0
+        return await self._download_and_convert_emojis(emojis, keyword, output_format, size_tier, expires)
+    
+    def _item(self, key: str, output_format: str, size_tier: str) -> Dict:
+        """列表条目：缩小档位的条目附带原尺寸地址"""
+        item = {'url': self._public_url(self._store.path_for(key, output_format, size_tier))}
+        if size_tier != FULL_TIER:
+            item['full_url'] = self._public_url(self._store.path_for(key, output_format))
+        return item
+    
+    def _lazy_items(self, emojis: List[Dict], output_format: str = 'gif', size_tier: str = FULL_TIER) -> List[Dict]:
+        """直接返回确定的仓库URL，并登记原图地址"""
+        items = []
+        sources = []
+        for emoji in emojis:
+            origin_urls = emoji.get('origin', {}).get('url_list', [])
+            key = self._store.key_for(emoji)
+            if not origin_urls or not key:
+                continue
+            path = self._store.path_for(key, output_format, size_tier)
+            if not self._lookup(path):
+                sources.append((key, origin_urls))
+            items.append(self._item(key, output_format, size_tier))
+        if sources:
+            self._store.register_sources(sources)
+        return items
+    
+    async def resolve_download(self, path: str) -> Optional[Path]:
+        """返回下载目录中可直接发送的文件；仓库文件不存在时按登记的原图地址现场转换"""
+        root = Path(self.config['download_dir']).resolve()
+        target = (root / path).resolve()
+        if root not in target.parents or target.suffix.lower() not in SERVABLE_SUFFIXES:
+            return None
+        if target.is_file():
+            self._store.lookup(path)
+            return target
+        
+        parsed = self._store.parse_path(path)
+        if not parsed or parsed[1] not in self._image_configs:
+            return None
+        key = parsed[0]
+        urls = self._store.sources(key)
+        if not urls:
+            return None
+        if await self._ensure_converted(path, key, urls):
+            return target
+        return None
+    
+    def file_etag(self, path: str) -> Optional[str]:
+        """仓库文件的内容哈希，不在仓库中的文件返回None"""
+        return self._store.etag(path)
     
-    async def _download_and_convert_emojis(self, emojis: List[Dict], keyword: str) -> List[Dict]:
-        """下载并转换表情包"""
+    def touch(self, path: str):
+        """记录仓库文件被访问（从内存层发送时不经过resolve_download）"""
+        self._store.lookup(path)
+    
+    async def _download_and_convert_emojis(self, emojis: List[Dict], keyword: str, output_format: str = 'gif',
+                                           size_tier: str = FULL_TIER,
+                                           expires: Optional[float] = None) -> Tuple[List[Dict], int]:
+        """下载并转换表情包，结果顺序与sticker_list保持一致；各格式、各尺寸的结果在仓库中并存
+
+        expires为事件循环时间表示的截止时刻：到时仍未完成的表情包不等待，转入后台继续转换，
+        下次请求时从仓库直接返回。返回(已就绪的条目, 未就绪的数量)。
+        """
         if not emojis:
-            return []
+            return [], 0
         
-        if keyword:
-            folder_name = self._sanitize_filename(keyword)
-        else:
-            folder_name = 'home'
-        folder_path = Path(self.config['download_dir']) / folder_name
-        folder_path.mkdir(exist_ok=True) 
-        converted_items = []
+        results: List[Optional[Dict]] = [None] * len(emojis)
+        pending: Dict[str, List[int]] = {}
+        jobs: Dict[str, Tuple] = {}
         
         for i, emoji in enumerate(emojis):
             origin_urls = emoji.get('origin', {}).get('url_list', [])
-            if not origin_urls:
+            key = self._store.key_for(emoji)
+            if not origin_urls or not key:
                 continue
-            original_url = origin_urls[0]
-            filename = self._generate_filename(original_url)
-            gif_path = folder_path / f"{filename}.gif"
+            path = self._store.path_for(key, output_format, size_tier)
+            item = self._item(key, output_format, size_tier)
             
-            if gif_path.exists():
-                converted_items.append({
-                    'url': f"{self.config['base_url']}/{folder_path}/{filename}.gif"
-                })
+            if self._lookup(path):
+                results[i] = item
                 continue
-            
+            if path in pending:
+                pending[path].append(i)
+                continue
+            pending[path] = [i]
+            jobs[path] = (key, origin_urls, item)
+        
+        deferred = 0
+        if pending:
+            tasks = {
+                asyncio.ensure_future(self._ensure_converted(path, *jobs[path][:2])): path for path in pending
+            }
+            timeout = None if expires is None else max(0, expires - asyncio.get_running_loop().time())
             try:
-                success = await self._process_single_emoji(original_url, gif_path)
-                if success:
-                    converted_items.append({
-                        'url': f"{self.config['base_url']}/{folder_path}/{filename}.gif"
-                    })
-            except Exception as e:
-                logger.error(f"处理表情包失败 {i}: {e}")
+                done, unfinished = await asyncio.wait(tasks, timeout=timeout)
+            except asyncio.CancelledError:
+                # 客户端断开：放弃等待，没有其他请求或后台任务在等待的下载转换随之取消
+                for task in tasks:
+                    task.cancel()
+                raise
+            for task in done:
+                path = tasks[task]
+                if task.exception() is not None:
+                    logger.error(f"处理表情包失败 {pending[path][0]}: {task.exception()}")
+                elif task.result():
+                    for index in pending[path]:
+                        results[index] = jobs[path][2]
+            for task in unfinished:
+                # 转换本身由_conversion_flight持有，这里只保留等待者的引用并记录结果
+                deferred += len(pending[tasks[task]])
+                self._background_tasks.add(task)
+                task.add_done_callback(lambda t, path=tasks[task]: self._deferred_done(path, t))
+            if deferred:
+                self._deferred_items += deferred
+                metrics.DEFERRED_ITEMS.inc(deferred)
         
-        return converted_items
+        return [item for item in results if item], deferred
     
-    async def _process_single_emoji(self, url: str, output_path: Path) -> bool:
-        """处理单个表情包：下载并转换为GIF"""
-        try:
-            temp_file = await self._download_image(url)
-            if not temp_file:
-                return False
-            
+    def _deferred_done(self, path: str, task: asyncio.Task):
+        """超过响应时限、在后台完成的转换"""
+        self._background_tasks.discard(task)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.error(f"后台转换失败 {path}: {task.exception()}")
+        elif task.result():
+            logger.debug(f"后台转换完成 {path}")
+    
+    def _lookup(self, path: str) -> bool:
+        """查询仓库并记录命中情况"""
+        found = self._store.lookup(path)
+        metrics.STORE_LOOKUPS.inc(result='hit' if found else 'miss')
+        return found
+    
+    def _public_url(self, path: str) -> str:
+        """仓库文件对外访问的URL"""
+        return f"{self.config['base_url']}/{Path(self.config['download_dir']).as_posix()}/{path}"
+    
+    async def _ensure_converted(self, path: str, key: str, urls: List[str]) -> bool:
+        """确保仓库中有该文件：同一输出文件同时只处理一次，后来的请求等待进行中的任务"""
+        success, shared = await self._conversion_flight.do(path, lambda: self._produce(path, key, urls))
+        if shared:
+            self._coalesced_conversions += 1
+        return success
+    
+    async def _produce(self, path: str, key: str, urls: List[str]) -> bool:
+        """下载并转换单个文件
+
+        文件已存在但不在索引中（其他进程或离线转换工具生成的）时直接登记，不重复转换。
+        """
+        if self._adopt_existing(path, key, urls):
+            return True
+        return await self._submit(path, key, urls)
+    
+    def _adopt_existing(self, path: str, key: str, urls: List[str]) -> bool:
+        if not self._store.absolute(path).exists():
+            return False
+        self._store.add(path, key, urls, self._fingerprint(path))
+        return True
+    
+    def _fingerprint(self, path: str) -> str:
+        """仓库文件对应尺寸档位的转换配置指纹"""
+        return self._config_fingerprints[self._store.parse_path(path)[1]]
+    
+    async def _submit(self, path: str, key: str, urls: List[str]) -> bool:
+        """把任务交给下载→转换流水线，等待转换结果"""
+        self._ensure_pipeline()
+        future = asyncio.get_running_loop().create_future()
+        self._download_queue.put_nowait((path, key, urls, future))
+        return await future
+    
+    def _ensure_pipeline(self):
+        """按需启动全局的下载→转换两级流水线，各级按配置限流，中间用有界队列衔接"""
+        if self._pipeline_tasks:
+            return
+        performance = self.config['performance']
+        if performance.get('enable_parallel', True):
+            download_workers = max(1, performance.get('max_concurrent_downloads', 1))
+            # 未配置时与转换进程池大小相同，每个转换进程都有任务可做
+            convert_workers = max(1, performance.get('max_concurrent_conversions') or self._pool_size())
+        else:
+            download_workers = convert_workers = 1
+        
+        self._download_queue = asyncio.Queue()
+        self._convert_queue = asyncio.Queue(maxsize=convert_workers * 2)
+        self._pipeline_tasks = (
+            [asyncio.create_task(self._download_worker()) for _ in range(download_workers)] +
+            [asyncio.create_task(self._convert_worker()) for _ in range(convert_workers)]
+        )
+    
+    async def _download_worker(self):
+        while True:
+            path, key, urls, future = await self._download_queue.get()
+            if future.done():
+                # 等待该表情包的请求都已断开
+                metrics.ABANDONED_JOBS.inc(stage='download_queue')
+                continue
+            try:
+                with metrics.INFLIGHT.track(stage='download'):
+                    source = await self._unless_abandoned(future, self._download_image(urls))
+            except Exception as e:
+                logger.error(f"下载表情包失败 {path}: {e}")
+                source = None
+            if future.cancelled():
+                metrics.ABANDONED_JOBS.inc(stage='download')
+                if isinstance(source, str):
+                    Path(source).unlink(missing_ok=True)
+                continue
+            if not source:
+                if not future.done():
+                    future.set_result(False)
+                continue
+            await self._convert_queue.put((path, key, urls, future, source))
+    
+    async def _convert_worker(self):
+        while True:
+            path, key, urls, future, source = await self._convert_queue.get()
+            success = False
             try:
-                success = await self._convert_to_gif(temp_file, output_path)
-                return success
+                if future.done():
+                    metrics.ABANDONED_JOBS.inc(stage='convert_queue')
+                else:
+                    success = bool(await self._unless_abandoned(future, self._publish(source, path, key, urls)))
+                    if not success and future.cancelled():
+                        metrics.ABANDONED_JOBS.inc(stage='convert')
+            except Exception as e:
+                logger.error(f"处理表情包失败 {path}: {e}")
+                success = False
             finally:
-                if temp_file and Path(temp_file).exists():
-                    Path(temp_file).unlink()
-                    
-        except Exception as e:
-            logger.error(f"处理表情包失败: {e}")
+                if isinstance(source, str):
+                    Path(source).unlink(missing_ok=True)
+                if not future.done():
+                    future.set_result(success)
+    
+    async def _publish(self, source: Union[bytes, str], path: str, key: str, urls: List[str]) -> bool:
+        """转换并登记到仓库；开启文件锁时与其他进程互斥，拿到锁后先看其他进程是否已经生成
+
+        锁按路径哈希分条带，只在转换和登记期间持有，不覆盖下载和流水线排队，
+        同一条带上不相关的表情包不会互相等待对方的下载。
+        """
+        if not self._file_lock:
+            return await self._convert_and_add(source, path, key, urls)
+        
+        async with FileLock(self._store.lock_path(path)):
+            if self._adopt_existing(path, key, urls):
+                return True
+            return await self._convert_and_add(source, path, key, urls)
+    
+    async def _convert_and_add(self, source: Union[bytes, str], path: str, key: str, urls: List[str]) -> bool:
+        etag = await self._convert_image(source, path, key)
+        if not etag:
             return False
+        self._conversions += 1
+        self._store.add(path, key, urls, self._fingerprint(path), etag)
+        return True
     
-    async def _download_image(self, url: str, max_retries: int = None) -> Optional[str]:
-        """完全使用curl下载图片，模拟PHP的下载方式"""
+    @staticmethod
+    async def _unless_abandoned(future: asyncio.Future, coro):
+        """执行流水线的一个阶段；等待结果的请求都已断开（future被取消）时中止该阶段并返回None
+
+        已提交到转换进程池、尚未开始的转换随之取消；已在转换进程中执行的转换无法中途停止，
+        完成后的文件在下次需要时由_adopt_existing登记。
+        """
+        task = asyncio.ensure_future(coro)
+        
+        def abort(f):
+            if f.cancelled():
+                task.cancel()
+        future.add_done_callback(abort)
+        try:
+            # 用wait等待：流水线本身被取消（服务退出）时总是向上抛出，不与阶段被中止混淆
+            await asyncio.wait([task])
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            future.remove_done_callback(abort)
+        return None if task.cancelled() else task.result()
+    
+    async def _download_image(self, urls: List[str], max_retries: int = None) -> Optional[Union[bytes, str]]:
+        """从url_list中的镜像下载图片，返回内存中的内容；超过落盘阈值时返回临时文件路径"""
         if max_retries is None:
             max_retries = self.config['performance'].get('max_retries', 2)
         
@@ -221,318 +752,295 @@ class EmoticonAPI:
                     delay = self.config['performance'].get('retry_delay', 0.5)
                     await asyncio.sleep(delay)
                 
-                success = await self._download_with_curl(url)
+                success = await self._download_hedged(urls)
                 if success:
                     return success
                 
-                logger.warning(f"curl下载失败 (尝试 {attempt + 1}/{max_retries}): {url}")
+                logger.warning(f"下载失败 (尝试 {attempt + 1}/{max_retries}): {urls[0]}")
                 
             except Exception as e:
-                logger.error(f"下载异常 (尝试 {attempt + 1}/{max_retries}): {e} - {url}")
+                logger.error(f"下载异常 (尝试 {attempt + 1}/{max_retries}): {e} - {urls[0]}")
                 await asyncio.sleep(0.5)
         
-        logger.error(f"下载失败，已重试 {max_retries} 次: {url}")
+        logger.error(f"下载失败，已重试 {max_retries} 次: {urls[0]}")
         return None
     
-    async def _download_with_curl(self, url: str) -> Optional[str]:
-        """使用系统curl命令下载，完全模拟PHP的方式"""
+    async def _download_hedged(self, urls: List[str]) -> Optional[Union[bytes, str]]:
+        """对冲下载：先请求第一个镜像，超过该主机近期p95延迟仍未完成时再请求下一个镜像，取最先成功的结果
+
+        某个镜像失败时立即换下一个；熔断中的主机排在最后。同时进行的请求不超过hedge_max_mirrors个，
+        先完成的一方胜出后取消其余请求。
+        """
+        performance = self.config['performance']
+        max_parallel = max(1, performance.get('hedge_max_mirrors', 2)) if performance.get('hedge_downloads', True) else 1
+        candidates = self._upstreams.order(urls)
+        running: Dict[asyncio.Task, str] = {}
+        primary = None
         try:
-            temp_file = tempfile.mktemp(suffix='.tmp')
-            
-            cmd = [
-                'curl', '-L', '-s',
-                '-H', 'User-Agent: Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36',
-                '-H', 'Accept: */*',
-                '-H', 'Accept-Language: zh-CN,zh;q=0.9,en;q=0.8',
-                '--connect-timeout', '10',
-                '--max-time', '30',
-                '-o', temp_file,
-                url
-            ]
-            
-            if await self._execute_curl_cmd(cmd, temp_file):
-                logger.info(f"curl下载成功: {url}")
-                return temp_file
-            logger.warning("标准curl参数失败，尝试激进参数")
-            cmd = [
-                'curl', '-L', '-s',
-                '-H', 'User-Agent: curl/7.68.0',
-                '-H', 'Accept: */*',
-                '--connect-timeout', '15',
-                '--max-time', '45',
-                '--retry', '2',
-                '--retry-delay', '1',
-                '-o', temp_file,
-                url
-            ]
-            
-            if await self._execute_curl_cmd(cmd, temp_file):
-                logger.info(f"激进curl参数下载成功: {url}")
-                return temp_file
-            
-            logger.warning("激进curl参数失败，尝试最简参数")
-            cmd = [
-                'curl', '-L', '-s',
-                '--connect-timeout', '20',
-                '--max-time', '60',
-                '-o', temp_file,
-                url
-            ]
-            
-            if await self._execute_curl_cmd(cmd, temp_file):
-                logger.info(f"最简curl参数下载成功: {url}")
-                return temp_file
-            
-            logger.error(f"所有curl参数都失败了: {url}")
-            if Path(temp_file).exists():
-                Path(temp_file).unlink()
-            return None
-                
-        except Exception as e:
-            logger.error(f"curl下载异常: {e}")
-            return None
+            while True:
+                if candidates and len(running) < max_parallel:
+                    url = candidates.pop(0)
+                    task = asyncio.ensure_future(self._download_with_profiles(url))
+                    running[task] = url
+                    if primary is None:
+                        primary = task
+                    else:
+                        metrics.HEDGED_DOWNLOADS.inc(result='launched')
+                        logger.debug(f"发出对冲请求: {url}")
+                if not running:
+                    return None
+                # 还能再发对冲请求时，只等待最近发出的请求所在主机的p95延迟
+                delay = None
+                if candidates and len(running) < max_parallel:
+                    delay = self._upstreams.for_url(url).hedge_delay()
+                done, _ = await asyncio.wait(running, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    running.pop(task)
+                    body = task.result()
+                    if body:
+                        if task is not primary:
+                            metrics.HEDGED_DOWNLOADS.inc(result='won')
+                        return body
+        finally:
+            for task in running:
+                task.cancel()
+            for body in await asyncio.gather(*running, return_exceptions=True):
+                # 取消前已经下载完成并落盘的结果
+                if isinstance(body, str):
+                    Path(body).unlink(missing_ok=True)
     
-    async def _execute_curl_cmd(self, cmd: list, temp_file: str) -> bool:
-        """执行curl命令的通用函数"""
+    async def _download_with_profiles(self, url: str) -> Optional[Union[bytes, str]]:
+        """依次使用标准、激进、最简请求头下载，复用共享连接池
+
+        连接和读取超时按该主机近期的p99延迟自适应缩短，总超时按方案配置；主机熔断时直接放弃。
+        每次调用只向主机的熔断器记录一次结果：任一方案成功计为成功，所有方案都失败且其中出现过
+        连接错误、等待响应超时或5xx时计为一次失败；4xx、空响应和响应体传输中超时只与该文件有关，不计入。
+        """
+        health = self._upstreams.for_url(url)
+        if not health.allow():
+            health.skipped += 1
+            metrics.CIRCUIT_SKIPS.inc(target='cdn')
+            logger.warning(f"CDN主机熔断中，跳过: {url}")
+            return None
+        host_error = False
         try:
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            
-            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=70)
-            
-            if process.returncode == 0 and Path(temp_file).exists() and Path(temp_file).stat().st_size > 0:
-                return True
-            else:
-                if stderr:
-                    logger.debug(f"curl命令执行失败: {stderr.decode()}")
-                return False
-                
-        except Exception as e:
-            logger.debug(f"curl命令执行异常: {e}")
-            return False
+            for name, headers, connect_timeout, total_timeout in DOWNLOAD_PROFILES:
+                if name == '标准':
+                    total_timeout = self.config['performance'].get('download_timeout', total_timeout)
+                read_timeout = health.timeout(total_timeout)
+                started = time.perf_counter()
+                body, failed = await self._fetch_body(
+                    url, headers, min(connect_timeout, read_timeout), read_timeout, total_timeout
+                )
+                elapsed = time.perf_counter() - started
+                metrics.DOWNLOAD_SECONDS.observe(elapsed, profile=name, result='ok' if body else 'error')
+                if body:
+                    health.success(elapsed)
+                    logger.info(f"{name}参数下载成功: {url}")
+                    metrics.DOWNLOAD_PROFILE.inc(profile=name)
+                    metrics.DOWNLOAD_BYTES.inc(len(body) if isinstance(body, bytes) else os.path.getsize(body))
+                    return body
+                host_error = host_error or failed
+                logger.warning(f"{name}参数下载失败: {url}")
+        except asyncio.CancelledError:
+            health.release()
+            raise
+        
+        if host_error:
+            health.failure()
+        else:
+            health.release()
+        logger.error(f"所有下载参数都失败了: {url}")
+        metrics.DOWNLOAD_PROFILE.inc(profile='all_failed')
+        return None
     
-    async def _convert_to_gif(self, input_path: str, output_path: Path) -> bool:
-        """转换图片为GIF，保持动图效果"""
+    async def _fetch_body(self, url: str, headers: Dict, connect_timeout: float, read_timeout: float,
+                          total_timeout: float) -> Tuple[Optional[Union[bytes, str]], bool]:
+        """流式读取响应体到内存，超过落盘阈值后转存临时文件
+
+        read_timeout限制等待首字节和两次读取之间的时间，total_timeout限制整个下载。
+        返回(响应体, 是否为主机故障)：连接错误、等待响应超时和5xx算主机故障，
+        4xx、空响应和开始接收响应体之后的超时与该文件本身有关，不算。
+        """
+        spill_threshold = self.config['performance'].get('memory_spill_threshold', 8 * 1024 * 1024)
+        buffer = bytearray()
+        spill_file = None
+        spill_path = None
+        streaming = False
         try:
-            is_animated = await self._detect_animated_image(input_path)
-            if is_animated:
-                return await self._convert_animated_to_gif(input_path, output_path)
-            else:
-                return await self._convert_static_to_gif(input_path, output_path)
-                
+            timeout = aiohttp.ClientTimeout(total=total_timeout, sock_connect=connect_timeout, sock_read=read_timeout)
+            session = self._get_session()
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                if response.status != 200:
+                    logger.debug(f"下载返回状态码 {response.status}: {url}")
+                    return None, response.status >= 500
+                streaming = True
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    if spill_file is None and len(buffer) + len(chunk) > spill_threshold:
+                        fd, spill_path = tempfile.mkstemp(suffix='.tmp')
+                        spill_file = os.fdopen(fd, 'wb')
+                        spill_file.write(buffer)
+                        buffer.clear()
+                    if spill_file is not None:
+                        spill_file.write(chunk)
+                    else:
+                        buffer.extend(chunk)
+            if spill_file is not None:
+                spill_file.close()
+                spill_file = None
+                logger.info(f"响应体超过{spill_threshold}字节，已转存临时文件: {url}")
+                result, spill_path = spill_path, None
+                return result, False
+            return (bytes(buffer) if buffer else None), False
         except Exception as e:
-            logger.error(f"转换失败: {e}")
-            return False
+            logger.debug(f"下载请求异常: {e}")
+            return None, not (streaming and isinstance(e, asyncio.TimeoutError))
+        finally:
+            if spill_file is not None:
+                spill_file.close()
+            if spill_path:
+                Path(spill_path).unlink(missing_ok=True)
     
-    async def _detect_animated_image(self, file_path: str) -> bool:
-        """检测是否为动图"""
-        try:
-            import imageio
-            
-            reader = imageio.get_reader(file_path)
-            if hasattr(reader, 'length'):
-                return reader.length > 1
-            else:
-                frames = []
-                for frame in reader:
-                    frames.append(frame)
-                    if len(frames) > 1:
-                        return True
-                return False
-                
-        except Exception as e:
-            logger.warning(f"动图检测失败，使用文件扩展名判断: {e}")
-            ext = Path(file_path).suffix.lower()
-            return ext in ['.gif', '.webp', '.apng']
+    def _get_session(self) -> aiohttp.ClientSession:
+        """获取共享的HTTP会话，按主机复用连接并缓存DNS"""
+        if self._session is None or self._session.closed:
+            performance = self.config['performance']
+            connector = aiohttp.TCPConnector(
+                limit=performance.get('http_pool_size', 100),
+                limit_per_host=performance.get('http_pool_per_host', 16),
+                ttl_dns_cache=performance.get('dns_cache_ttl', 300),
+                keepalive_timeout=performance.get('keepalive_timeout', 30)
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
     
-    async def _convert_animated_to_gif(self, input_path: str, output_path: Path) -> bool:
-        """转换动图为GIF，保持动画"""
+    async def _convert_image(self, source: Union[bytes, str], path: str, key: str) -> Optional[str]:
+        """按仓库路径的格式和尺寸档位转换：已符合要求的GIF直接原样保存，其余在转换进程池中转换，不阻塞事件循环
+
+        成功时返回输出文件的内容哈希（下载时用作ETag），失败返回None。
+        转换时限从转换进程开始执行时计时，由转换进程逐帧检查，不含在进程池中排队的时间。
+        """
+        timeout = self.config['performance'].get('conversion_timeout', 60)
+        loop = asyncio.get_running_loop()
+        output_path = self._store.absolute(path)
+        image_config = self._image_configs[self._store.parse_path(path)[1]]
+        output_format = output_path.suffix.lstrip('.')
+        info = self._store.probe_info(key)
+        if info is None:
+            # 内存数据只解析文件头和块结构，很快；落盘文件在线程中探测
+            started = time.perf_counter()
+            if isinstance(source, str):
+                info = await loop.run_in_executor(None, converter.probe, source)
+            else:
+                info = converter.probe(source)
+            metrics.PROBE_SECONDS.observe(time.perf_counter() - started, format=(info or {}).get('format', 'unknown'))
+            if info is not None:
+                self._store.record_probe(key, info)
+        if output_format == 'gif' and converter.can_passthrough(info, image_config):
+            self._passthroughs += 1
+            with metrics.FILE_WRITE_SECONDS.time():
+                success = await loop.run_in_executor(None, converter.passthrough, source, str(output_path))
+            metrics.CONVERSIONS.inc(format=output_format, method='passthrough', result='ok' if success else 'error')
+            if not success:
+                return None
+            # 原样保存的文件与原图逐字节相同，直接对原图算哈希
+            return await loop.run_in_executor(None, converter.file_digest, source)
+
+        started = time.perf_counter()
+        executor = self._get_executor()
         try:
-            conversion_methods = [
-                ('imageio', self._convert_with_imageio, '保持动画')
-            ]
-            
-            for method_name, method_func, description in conversion_methods:
-                try:
-                    success = await method_func(input_path, output_path, animated=True)
-                    
-                    if success:
-                        logger.info(f"{method_name}转换成功（{description}）")
-                        return True
-                except Exception as e:
-                    logger.debug(f"{method_name}转换失败: {e}")
-            
-            if input_path.lower().endswith('.gif'):
-                try:
-                    import shutil
-                    shutil.copy2(input_path, output_path)
-                    logger.info("直接复制GIF文件成功")
-                    return True
-                except Exception as e:
-                    logger.error(f"复制GIF文件失败: {e}")
-            
-            logger.error("所有动图转换方案都失败了")
-            return False
-            
-        except Exception as e:
-            logger.error(f"动图转换失败: {e}")
-            return False
+            with metrics.INFLIGHT.track(stage='convert_pool'):
+                success, report = await loop.run_in_executor(
+                    executor, converter.convert_with_report,
+                    source, str(output_path), image_config, timeout, False
+                )
+        except BrokenProcessPool as e:
+            logger.error(f"转换进程池异常，将重建: {e}")
+            # 同一个进程池上的其他转换也会失败，只由第一个发现的关闭并丢弃，不影响已重建的新进程池
+            if self._executor is executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            metrics.CONVERSIONS.inc(format=output_format, method='none', result='broken_pool')
+            return None
+        metrics.CONVERT_WAIT_SECONDS.observe(
+            max(0.0, time.perf_counter() - started - report['seconds']), format=output_format
+        )
+        if report['timed_out']:
+            logger.error(f"转换超时（{timeout}秒）: {output_path}")
+            metrics.CONVERSIONS.inc(format=output_format, method='none', result='timeout')
+            return None
+        metrics.CONVERT_SECONDS.observe(report['seconds'], format=output_format, method=report['method'])
+        metrics.CONVERSIONS.inc(format=output_format, method=report['method'], result='ok' if success else 'error')
+        return report['etag'] if success else None
     
-    async def _convert_static_to_gif(self, input_path: str, output_path: Path) -> bool:
-        """转换静图为GIF"""
-        try:
-            conversion_methods = [
-                ('Pillow', self._convert_with_pillow, '静图处理效果最好'),
-                ('imageio', self._convert_with_imageio, '通用图像处理')
-            ]
-            
-            for method_name, method_func, description in conversion_methods:
-                try:
-                    if method_name == 'imageio':
-                        success = await method_func(input_path, output_path, animated=False)
-                    else:
-                        success = await method_func(input_path, output_path)
-                    
-                    if success:
-                        logger.info(f"{method_name}转换静图成功（{description}）")
-                        return True
-                except ImportError:
-                    if method_name == 'Pillow':
-                        logger.warning("Pillow未安装")
-                except Exception as e:
-                    if method_name == 'Pillow':
-                        logger.warning(f"{method_name}转换失败: {e}")
-                    else:
-                        logger.debug(f"{method_name}转换失败: {e}")
-            
-            logger.error("所有静图转换方案都失败了")
-            return False
-            
-        except Exception as e:
-            logger.error(f"静图转换失败: {e}")
-            return False
+    def _pool_size(self) -> int:
+        """转换进程池大小：未配置时多进程模式下各服务进程平分CPU核心"""
+        return (self.config['performance'].get('conversion_workers')
+                or max(1, (os.cpu_count() or 1) // self._worker_count))
     
-    def _get_resize_dimensions(self, width: int, height: int, max_size: int = None) -> tuple:
-        if max_size is None:
-            max_size = self.config['image']['max_image_size']
-        """计算调整后的尺寸，保持宽高比"""
-        if width <= max_size and height <= max_size:
-            return width, height
-        
-        scale = min(max_size / width, max_size / height)
-        new_width = int(width * scale)
-        new_height = int(height * scale)
-        
-        logger.info(f"尺寸压缩: {width}x{height} → {new_width}x{new_height}")
-        return new_width, new_height
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """获取转换进程池，未启动时按需创建"""
+        if self._executor is None:
+            workers = self._pool_size()
+            self._executor = ProcessPoolExecutor(max_workers=workers, initializer=converter.init_worker)
+            self._executor_workers = workers
+        return self._executor
     
-    def _resize_image_with_pil(self, frame, new_width: int, new_height: int):
-        """使用PIL调整图片尺寸，避免重复导入"""
-        try:
-            import numpy as np
-            from PIL import Image
-            pil_img = Image.fromarray(frame)
-            pil_img = pil_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            return np.array(pil_img)
-        except Exception as e:
-            logger.warning(f"PIL尺寸调整失败: {e}")
-            return frame
-
-    async def _convert_with_pillow(self, input_path: str, output_path: Path) -> bool:
-        """使用Pillow转换静图"""
-        try:
-            from PIL import Image
-            
-            with Image.open(input_path) as img:
-                if img.mode in ('RGBA', 'LA', 'P'):
-                    background = Image.new('RGB', img.size, (255, 255, 255))
-                    if img.mode == 'P':
-                        img = img.convert('RGBA')
-                    background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                    img = background
-                elif img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                original_width, original_height = img.size
-                new_width, new_height = self._get_resize_dimensions(original_width, original_height)
-                if new_width != original_width or new_height != original_height:
-                    img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                img.save(output_path, 'GIF', optimize=True)
-                return True
-                
-        except Exception as e:
-            logger.error(f"Pillow转换失败: {e}")
-            return False
+    def stats(self) -> Dict:
+        """运行状态统计"""
+        return {
+            'response_cache': self._response_cache.stats(),
+            'cursor_store': len(self._cursor_store),
+            'prefetching': len(self._prefetching),
+            'store': self._store.stats(),
+            'conversions': self._conversions,
+            'coalesced_conversions': self._coalesced_conversions,
+            'abandoned_conversions': self._conversion_flight.abandoned,
+            'deferred_items': self._deferred_items,
+            'passthroughs': self._passthroughs,
+            'inflight_conversions': len(self._conversion_flight),
+            'upstreams': self._upstreams.stats()
+        }
     
-    async def _convert_with_imageio(self, input_path: str, output_path: Path, animated: bool) -> bool:
-        """使用imageio转换"""
-        try:
-            import imageio
-            import numpy as np
-            
-            if animated:
-                reader = imageio.get_reader(input_path)
-                frames = []
-                for frame in reader:
-                    frames.append(frame)
-                
-                if len(frames) > 1:
-                    resized_frames = []
-                    for frame in frames:
-                        h, w = frame.shape[:2]
-                        new_h, new_w = self._get_resize_dimensions(w, h)
-                        
-                        if new_h != h or new_w != w:
-                            resized_frame = self._resize_image_with_pil(frame, new_w, new_h)
-                        else:
-                            resized_frame = frame
-                        resized_frames.append(resized_frame)
-                    
-                    imageio.mimsave(output_path, resized_frames, format='GIF', fps=self.config['image']['gif_fps'])
-                    return True
-                else:
-                    return await self._convert_static_to_gif(input_path, output_path)
-            else:
-                reader = imageio.get_reader(input_path)
-                frame = reader.get_data(0)
-                
-                h, w = frame.shape[:2]
-                new_h, new_w = self._get_resize_dimensions(w, h)
-                
-                if new_h != h or new_w != w:
-                    frame = self._resize_image_with_pil(frame, new_w, new_h)
-                
-                imageio.imwrite(output_path, frame, format='GIF')
-                return True
-                
-        except Exception as e:
-            logger.error(f"imageio转换失败: {e}")
-            return False
+    def update_metrics(self):
+        """把队列长度和已有的统计同步到指标，在输出 /metrics 前调用"""
+        metrics.QUEUE_DEPTH.set(self._download_queue.qsize() if self._download_queue else 0, queue='download')
+        metrics.QUEUE_DEPTH.set(self._convert_queue.qsize() if self._convert_queue else 0, queue='convert')
+        metrics.INFLIGHT.set(self._live_requests, stage='requests')
+        metrics.INFLIGHT.set(len(self._conversion_flight), stage='conversions')
+        metrics.INFLIGHT.set(len(self._prefetching), stage='prefetch')
+        self._upstreams.update_metrics()
+        cache_stats = self._response_cache.stats()
+        for field, result in (('hits', 'hit'), ('misses', 'miss'), ('coalesced', 'coalesced')):
+            metrics.RESPONSE_CACHE.set_total(cache_stats[field], result=result)
     
-    def _generate_filename(self, url: str) -> str:
-        """从URL生成文件名"""
-        try:
-            parsed = urlparse(url)
-            filename = Path(parsed.path).stem
-            if not filename:
-                filename = f"emoji_{int(time.time())}"
-            return self._sanitize_filename(filename)
-        except:
-            return f"emoji_{int(time.time())}"
-    
-    def _sanitize_filename(self, filename: str) -> str:
-        """清理文件名，确保安全"""
-        unsafe_chars = '<>:"/\\|?*'
-        for char in unsafe_chars:
-            filename = filename.replace(char, '_')
-        
-        if len(filename) > 100:
-            filename = filename[:100]
-        
-        return filename
+    async def start(self):
+        """启动转换进程池并预热所有工作进程"""
+        executor = self._get_executor()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(executor, converter.warm_up) for _ in range(self._executor_workers)
+        ))
+        logger.info(f"转换进程池已就绪，工作进程数: {self._executor_workers}")
+    
+    async def close(self):
+        """取消后台任务，关闭HTTP会话和转换进程池"""
+        for task in list(self._background_tasks):
+            task.cancel()
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        for task in self._pipeline_tasks:
+            task.cancel()
+        await asyncio.gather(*self._pipeline_tasks, return_exceptions=True)
+        self._pipeline_tasks = []
+        self._cursor_store.close()
+        self._response_cache.close()
+        self._store.close()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
     
     def _get_ms_token(self) -> str:
         """获取msToken，优先使用配置的，否则生成随机值"""
@@ -557,13 +1065,27 @@ def _check_global_dependencies():
             except ImportError:
                 logger.warning(f"⚠️ {name}未安装，请运行: pip install {name}")
         
+        try:
+            __import__('imageio_ffmpeg')
+            logger.info("✅ imageio-ffmpeg已安装，支持输出mp4")
+        except ImportError:
+            logger.info("ℹ️ imageio-ffmpeg未安装，mp4格式不可用（可选: pip install imageio-ffmpeg）")
+        
         logger.info("✅ 使用优化的转换方案（Pillow + imageio）")
         _check_global_dependencies._checked = True
 _check_global_dependencies()
 
-api = EmoticonAPI()
+_api: Optional[EmoticonAPI] = None
+
+def get_api() -> EmoticonAPI:
+    """模块共享的EmoticonAPI实例，首次调用时创建；导入本模块时不打开数据库、不加载仓库索引"""
+    global _api
+    if _api is None:
+        _api = EmoticonAPI()
+    return _api
 
-async def handle_request(ac: str, wxid: str, start: int = 0, limit: int = 40, keyword: str = '') -> str:
+async def handle_request(ac: str, wxid: str, start: int = 0, limit: int = 40, keyword: str = '',
+                         output_format: str = 'gif', size_tier: Optional[str] = None) -> str:
     """处理HTTP请求"""
-    result = await api.process_request(ac, wxid, start, limit, keyword)
+    result = await get_api().process_request(ac, wxid, start, limit, keyword, output_format, size_tier)
     return json.dumps(result, ensure_ascii=False, indent=2)
\ No newline at end of file
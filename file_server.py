@@ -0,0 +1,198 @@
+import asyncio
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from aiohttp import web
+
+import metrics
+
+# 下载文件的Content-Type；部分系统的mimetypes没有webp，不依赖自动猜测
+CONTENT_TYPES = {
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.mp4': 'video/mp4',
+    '.png': 'image/png'
+}
+
+# 不在内存层的文件分块读取发送
+READ_CHUNK_SIZE = 256 * 1024
+
+# 不在仓库索引中的文件（旧版本直接放在下载目录下的）内容可能变化，只允许带ETag验证后使用缓存
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+
+
+def _read_range(path: Path, start: int, length: int) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(length)
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    """If-None-Match比较（弱比较：忽略W/前缀）"""
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    target = etag[2:] if etag.startswith('W/') else etag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == target:
+            return True
+    return False
+
+
+def _parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """解析单个字节范围，返回[start, end]闭区间；没有或无法识别时返回None（发送完整内容）
+
+    范围完全超出文件时抛出416。多个范围不支持，按完整内容返回。
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[6:].strip().partition('-')
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                raise ValueError
+            start, end = max(0, size - suffix), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else max(start, size - 1)
+    except ValueError:
+        return None
+    if end < start:
+        return None
+    if start >= size:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{size}'})
+    return start, min(end, size - 1)
+
+
+class StaticFiles:
+    """下载目录的文件服务：强ETag、长期缓存、条件请求、Range，以及内存中的热点文件层
+
+    仓库文件以转换时算好的内容哈希作ETag，同一路径只在转换配置变化后才会重新生成，
+    届时ETag随之改变。最近访问的小文件保存在按总字节数限制的LRU中，命中时不读磁盘；
+    内存中的副本与仓库索引中的ETag不一致（文件被重新生成或淘汰）时作废。
+    """
+
+    def __init__(self, api, performance: Dict):
+        self.api = api
+        self.cache_control = performance.get('static_cache_control', 'public, max-age=31536000, immutable')
+        self.hot_max_bytes = performance.get('hot_cache_bytes', 64 * 1024 * 1024)
+        self.hot_max_file = performance.get('hot_cache_max_file', 2 * 1024 * 1024)
+        # 路径 -> (内容哈希, 文件内容)
+        self._hot: 'OrderedDict[str, Tuple[str, bytes]]' = OrderedDict()
+        self._hot_bytes = 0
+        self.hot_hits = 0
+        self.disk_reads = 0
+        self.not_modified = 0
+        self.partial = 0
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        path = request.match_info['path']
+        entry = self._hot.get(path)
+        if entry is not None and entry[0] == self.api.file_etag(path):
+            self._hot.move_to_end(path)
+            self.api.touch(path)
+            return await self._respond(request, path, f'"{entry[0]}"', self.cache_control, len(entry[1]), entry[1])
+        if entry is not None:
+            self._discard(path)
+
+        file_path = await self.api.resolve_download(path)
+        if file_path is None:
+            raise web.HTTPNotFound()
+        stat = file_path.stat()
+        etag = self.api.file_etag(path)
+        if etag is not None:
+            tag, cache_control = f'"{etag}"', self.cache_control
+        else:
+            tag, cache_control = f'W/"{stat.st_mtime_ns:x}-{stat.st_size:x}"', REVALIDATE_CACHE_CONTROL
+
+        body = None
+        if (etag is not None and stat.st_size <= self.hot_max_file
+                and not _etag_matches(request.headers.get('If-None-Match'), tag)):
+            body = await asyncio.get_running_loop().run_in_executor(None, file_path.read_bytes)
+            self._admit(path, etag, body)
+        return await self._respond(request, path, tag, cache_control, stat.st_size, body, file_path)
+
+    async def _respond(self, request: web.Request, path: str, tag: str, cache_control: str, size: int,
+                       body: Optional[bytes], file_path: Optional[Path] = None) -> web.StreamResponse:
+        """body为内存中的完整内容；为None时从file_path分块读取"""
+        headers = {'ETag': tag, 'Cache-Control': cache_control}
+        if _etag_matches(request.headers.get('If-None-Match'), tag):
+            self.not_modified += 1
+            metrics.STATIC_RESPONSES.inc(source='not_modified')
+            return web.Response(status=304, headers=headers)
+        if file_path is None:
+            self.hot_hits += 1
+            metrics.STATIC_RESPONSES.inc(source='memory')
+        else:
+            self.disk_reads += 1
+            metrics.STATIC_RESPONSES.inc(source='disk')
+
+        headers['Content-Type'] = CONTENT_TYPES[Path(path).suffix.lower()]
+        headers['Accept-Ranges'] = 'bytes'
+        byte_range = None
+        if_range = request.headers.get('If-Range')
+        # If-Range只接受强ETag完全一致，否则忽略Range发送完整内容
+        if if_range is None or (if_range.strip() == tag and not tag.startswith('W/')):
+            byte_range = _parse_range(request.headers.get('Range'), size)
+
+        status = 200
+        start, end = 0, size - 1
+        if byte_range is not None:
+            start, end = byte_range
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            self.partial += 1
+        length = end - start + 1
+
+        if body is not None:
+            return web.Response(status=status, body=body[start:end + 1], headers=headers)
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = length
+        await response.prepare(request)
+        if request.method != 'HEAD':
+            loop = asyncio.get_running_loop()
+            offset = start
+            while offset <= end:
+                chunk = await loop.run_in_executor(
+                    None, _read_range, file_path, offset, min(READ_CHUNK_SIZE, end - offset + 1)
+                )
+                if not chunk:
+                    break
+                await response.write(chunk)
+                offset += len(chunk)
+        await response.write_eof()
+        return response
+
+    def _admit(self, path: str, etag: str, body: bytes):
+        """放入内存层，超出总字节数时淘汰最久未访问的文件"""
+        if self.hot_max_bytes <= 0:
+            return
+        self._discard(path)
+        self._hot[path] = (etag, body)
+        self._hot_bytes += len(body)
+        while self._hot_bytes > self.hot_max_bytes:
+            _, (_, evicted) = self._hot.popitem(last=False)
+            self._hot_bytes -= len(evicted)
+
+    def _discard(self, path: str):
+        entry = self._hot.pop(path, None)
+        if entry is not None:
+            self._hot_bytes -= len(entry[1])
+
+    def stats(self) -> Dict:
+        return {
+            'hot_files': len(self._hot),
+            'hot_bytes': self._hot_bytes,
+            'hot_max_bytes': self.hot_max_bytes,
+            'hot_hits': self.hot_hits,
+            'disk_reads': self.disk_reads,
+            'not_modified': self.not_modified,
+            'partial': self.partial
+        }
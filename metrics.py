@@ -0,0 +1,225 @@
+import time
+import bisect
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+# 耗时直方图的默认分桶（秒），覆盖从缓存命中到大图转换的范围
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """指标基类：按标签值分别记录，标签通过关键字参数传入
+
+    只在事件循环线程中更新，不加锁；每次更新只是一次字典查找和加法，可以常开。
+    """
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines += [f'{name}{labels} {_format_value(value)}' for name, labels, value in self.samples()]
+        return lines
+
+
+class Counter(Metric):
+    """只增不减的计数"""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels):
+        """从已有的累计计数（如缓存的命中次数）同步"""
+        self._values[self._key(labels)] = value
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge(Metric):
+    """当前值，可以直接设置，也可以随任务进出增减"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """进入时加一、退出时减一，统计进行中的数量"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram(Metric):
+    """分桶统计的分布，输出累计桶、总和与次数"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签：[各桶计数..., 超出最大桶的计数, 总和]
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """记录with块的耗时（秒）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, counts in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                yield f'{self.name}_bucket', labels, cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum', labels, counts[-1]
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Registry:
+    """指标注册表，render()输出Prometheus文本格式"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'指标已注册: {metric.name}')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+# 进程内共享的注册表
+REGISTRY = Registry()
+
+# Prometheus文本格式的Content-Type
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'emoji_request_seconds', '表情包列表请求的总耗时', ['code'])
+BATCH_SECONDS = REGISTRY.histogram(
+    'emoji_batch_request_seconds', '批量查询请求的总耗时（包括出错的请求）', ['mode', 'code'])
+BATCH_QUERIES = REGISTRY.counter(
+    'emoji_batch_queries_total', '批量请求中的查询数')
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    'emoji_upstream_request_seconds', '抖音接口请求耗时', ['result'])
+RESPONSE_CACHE = REGISTRY.counter(
+    'emoji_response_cache_total', '上游响应缓存查询次数（coalesced为合并到进行中的请求）', ['result'])
+STORE_LOOKUPS = REGISTRY.counter(
+    'emoji_store_lookups_total', '表情包仓库查询次数', ['result'])
+DOWNLOAD_SECONDS = REGISTRY.histogram(
+    'emoji_download_attempt_seconds', '单次下载尝试耗时（每个请求头方案一次）', ['profile', 'result'])
+DOWNLOAD_BYTES = REGISTRY.counter(
+    'emoji_download_bytes_total', '下载的原图字节数')
+DOWNLOAD_PROFILE = REGISTRY.counter(
+    'emoji_download_profile_total', '下载成功时使用的请求头方案（all_failed表示全部失败）', ['profile'])
+PROBE_SECONDS = REGISTRY.histogram(
+    'emoji_probe_seconds', '原图格式探测耗时', ['format'], buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+CONVERT_SECONDS = REGISTRY.histogram(
+    'emoji_convert_seconds', '转换进程内的转换耗时', ['format', 'method'])
+CONVERT_WAIT_SECONDS = REGISTRY.histogram(
+    'emoji_convert_queue_wait_seconds', '提交到进程池后等待空闲进程的时间', ['format'])
+CONVERSIONS = REGISTRY.counter(
+    'emoji_conversions_total', '转换结果，method为成功的方案（passthrough/Pillow/imageio/copy）',
+    ['format', 'method', 'result'])
+FILE_WRITE_SECONDS = REGISTRY.histogram(
+    'emoji_file_write_seconds', '原样保存GIF时的文件写入耗时', buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5))
+HEDGED_DOWNLOADS = REGISTRY.counter(
+    'emoji_hedged_downloads_total', '向备用镜像发出的对冲请求（launched）及其中先于主请求完成的次数（won）', ['result'])
+CIRCUIT_SKIPS = REGISTRY.counter(
+    'emoji_circuit_skips_total', '因主机熔断而跳过的请求', ['target'])
+CIRCUIT_STATE = REGISTRY.gauge(
+    'emoji_circuit_state', '各上游主机的熔断状态（0正常，1熔断，2半开）', ['host'])
+ABANDONED_JOBS = REGISTRY.counter(
+    'emoji_abandoned_jobs_total', '请求断开后丢弃或中止的下载转换任务，stage为所处阶段', ['stage'])
+DEFERRED_ITEMS = REGISTRY.counter(
+    'emoji_deferred_items_total', '超过响应时限未返回、转入后台继续转换的表情包数')
+ADMISSIONS = REGISTRY.counter(
+    'emoji_admissions_total', '请求准入结果（admitted/rate_limited/shed/timed_out）', ['result'])
+STATIC_RESPONSES = REGISTRY.counter(
+    'emoji_static_responses_total', '下载文件的响应来源（memory/disk/not_modified）', ['source'])
+INFLIGHT = REGISTRY.gauge(
+    'emoji_inflight', '进行中的任务数', ['stage'])
+QUEUE_DEPTH = REGISTRY.gauge(
+    'emoji_queue_depth', '排队中的任务数（输出指标时更新）', ['queue'])
@@ -1,14 +1,58 @@
+import sys
+import time
+import signal
 import asyncio
+import argparse
 import json
 import logging
+from typing import Optional
 from urllib.parse import parse_qs, urlparse
 from aiohttp import web
-from emoticon_api import EmoticonAPI
+import metrics
+import supervisor
+from admission import PRIORITY_HIGH, PRIORITY_LOW, AdmissionController, Rejected
+from config import SERVER_CONFIG
+from emoticon_api import EmoticonAPI, get_api
+from file_server import StaticFiles
+from warmer import CacheWarmer
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-api = EmoticonAPI()
+HOST = '0.0.0.0'
+PORT = 8000
+
+# 在init_app中创建：多进程模式下主进程只管理服务进程，不打开数据库、不加载仓库索引
+api: Optional[EmoticonAPI] = None
+warmer: Optional[CacheWarmer] = None
+static_files: Optional[StaticFiles] = None
+admission: Optional[AdmissionController] = None
+
+def _create_services():
+    """创建本进程共用的EmoticonAPI及依赖它的组件"""
+    global api, warmer, static_files, admission
+    if api is not None:
+        return
+    api = get_api()
+    warmer = CacheWarmer(api, api.config['performance'])
+    static_files = StaticFiles(api, api.config['performance'])
+    admission = AdmissionController(api.config['performance'])
+
+def _parse_deadline(value):
+    """请求参数deadline（秒）：不超过max_response_deadline，无法识别时使用配置的默认时限
+
+    deadline=0表示请求方希望等待全部完成，但不允许客户端取消时限，按max_response_deadline处理。
+    """
+    if not value:
+        return None
+    try:
+        deadline = float(value)
+    except ValueError:
+        return None
+    if deadline != deadline or deadline < 0:
+        return None
+    limit = api.config['performance'].get('max_response_deadline', 60)
+    return min(deadline, limit) if deadline > 0 else limit
 
 async def handle_emoticon_api(request):
     """处理表情包API请求"""
@@ -19,13 +63,32 @@ async def handle_emoticon_api(request):
         start = int(query.get('start', 0))
         limit = int(query.get('limit', 40))
         keyword = query.get('keyword', '')
+        output_format = query.get('format', 'gif')
+        size_tier = query.get('size') or None
+        deadline = _parse_deadline(query.get('deadline'))
         from urllib.parse import unquote
         if keyword:
             keyword = unquote(keyword)
-        logger.info(f"收到请求: ac={ac}, wxid={wxid}, start={start}, limit={limit}, keyword={keyword}")
-        result = await api.process_request(ac, wxid, start, limit, keyword)
+        logger.info(f"收到请求: ac={ac}, wxid={wxid}, start={start}, limit={limit}, keyword={keyword}, format={output_format}, size={size_tier}, deadline={deadline}")
+        started = time.perf_counter()
+        if wxid in api.config['allowed_wxids']:
+            # 不在允许列表中的请求直接由process_request返回403，不占用准入名额
+            priority = PRIORITY_HIGH if api.is_cheap(ac, keyword, start) else PRIORITY_LOW
+            async with admission.admit(wxid, priority):
+                result = await api.process_request(ac, wxid, start, limit, keyword, output_format, size_tier, deadline)
+        else:
+            result = await api.process_request(ac, wxid, start, limit, keyword, output_format, size_tier, deadline)
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, code=str(result.get('code')))
         return web.json_response(result)
         
+    except Rejected as e:
+        logger.warning(f"拒绝请求: wxid={request.query.get('wxid', '')}, {e.msg}")
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, code=str(e.status))
+        return web.json_response(
+            {'msg': e.msg, 'code': e.status, 'retry_after': e.retry_after},
+            status=e.status,
+            headers={'Retry-After': str(e.retry_after)}
+        )
     except Exception as e:
         logger.error(f"处理请求失败: {e}")
         error_response = {
@@ -34,33 +97,194 @@ async def handle_emoticon_api(request):
         }
         return web.json_response(error_response, status=500)
 
+async def handle_batch(request):
+    """批量查询：POST JSON {wxid, format, size, deadline, stream, queries: [{ac, keyword, start, limit}, ...]}
+
+    默认所有查询完成后返回一个JSON，results与queries一一对应；stream为true或请求头
+    Accept: application/x-ndjson 时按NDJSON逐行返回，每个查询完成即输出一行（带index）。
+    """
+    started = time.perf_counter()
+    response = None
+    try:
+        response = await _process_batch(request, started)
+        return response
+    finally:
+        # 参数错误、出错和客户端断开（code为aborted）的请求同样计入耗时
+        mode = 'ndjson' if type(response) is web.StreamResponse else 'json'
+        code = str(response.status) if response is not None else 'aborted'
+        metrics.BATCH_SECONDS.observe(time.perf_counter() - started, mode=mode, code=code)
+
+async def _process_batch(request, started: float) -> web.StreamResponse:
+    try:
+        body = await request.json()
+        if not isinstance(body, dict):
+            raise ValueError
+    except ValueError:
+        return web.json_response({'msg': '请求体不是有效的JSON对象', 'code': 400}, status=400)
+
+    wxid = str(body.get('wxid') or '')
+    queries = body.get('queries')
+    if not wxid or not isinstance(queries, list) or not queries:
+        return web.json_response({'msg': '缺少必要参数', 'code': 400}, status=400)
+    max_queries = api.config['performance'].get('max_batch_queries', 20)
+    if len(queries) > max_queries:
+        return web.json_response({'msg': f'单次最多{max_queries}个查询', 'code': 400}, status=400)
+    error, output_format, size_tier = api.check_request(wxid, body.get('format') or 'gif', body.get('size') or None)
+    if error:
+        return web.json_response(error, status=error['code'])
+    deadline = _parse_deadline(str(body['deadline'])) if body.get('deadline') is not None else None
+    stream = bool(body.get('stream')) or 'application/x-ndjson' in request.headers.get('Accept', '')
+    logger.info(f"收到批量请求: wxid={wxid}, {len(queries)}个查询, format={output_format}, size={size_tier}, stream={stream}")
+
+    def admit(ac, keyword, start):
+        # 每个查询分别准入：各占一个限速令牌和并发名额，第一页或已缓存的查询优先
+        return admission.admit(wxid, PRIORITY_HIGH if api.is_cheap(ac, keyword, start) else PRIORITY_LOW)
+
+    batch = api.iter_batch(queries, output_format, size_tier, deadline, admit)
+    metrics.BATCH_QUERIES.inc(len(queries))
+    try:
+        if stream:
+            return await _stream_batch(request, batch)
+        try:
+            results = [None] * len(queries)
+            async for index, result in batch:
+                results[index] = result
+        except Exception as e:
+            logger.error(f"处理批量请求失败: {e}")
+            return web.json_response({'msg': f'服务器错误: {str(e)}', 'code': 500}, status=500)
+        return web.json_response({
+            'msg': '请求成功',
+            'code': 200,
+            'format': output_format,
+            'size': size_tier,
+            'results': results,
+            'unique_items': len({item['url'] for result in results for item in result.get('items', [])}),
+            'process_time': f"{time.perf_counter() - started:.2f}s"
+        })
+    finally:
+        await batch.aclose()
+
+async def _stream_batch(request, batch) -> web.StreamResponse:
+    """NDJSON逐行输出批量查询结果，每个查询完成即发送
+
+    响应头发出后不能再改为错误响应：批量查询本身出错时输出一行错误（不带index）后正常结束；
+    写入失败（客户端断开）时异常向上抛出，连接随之关闭。
+    """
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson; charset=utf-8'})
+    await response.prepare(request)
+    while True:
+        try:
+            index, result = await batch.__anext__()
+        except StopAsyncIteration:
+            break
+        except Exception as e:
+            logger.error(f"处理批量请求失败: {e}")
+            await response.write((json.dumps({'msg': f'服务器错误: {str(e)}', 'code': 500}) + '\n').encode('utf-8'))
+            break
+        await response.write((json.dumps({'index': index, **result}) + '\n').encode('utf-8'))
+    await response.write_eof()
+    return response
+
+async def handle_download(request):
+    """下载目录文件：热点文件从内存发送，懒转换模式下首次访问时现场转换"""
+    return await static_files.handle(request)
+
 async def handle_health_check(request):
     """健康检查接口"""
     return web.json_response({
         'status': 'ok',
         'message': '表情包API服务运行正常',
-        'timestamp': asyncio.get_event_loop().time()
+        'timestamp': asyncio.get_event_loop().time(),
+        'stats': api.stats(),
+        'warmer': warmer.stats(),
+        'static': static_files.stats(),
+        'admission': admission.stats()
     })
 
+async def handle_metrics(request):
+    """Prometheus格式的运行指标"""
+    api.update_metrics()
+    metrics.QUEUE_DEPTH.set(admission.stats()['queued'], queue='admission')
+    metrics.INFLIGHT.set(admission.active, stage='admitted')
+    return web.Response(body=metrics.REGISTRY.render().encode('utf-8'), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+async def on_startup(app):
+    """启动时预热转换进程池"""
+    await api.start()
+
+async def on_cleanup(app):
+    """退出时释放转换进程池"""
+    await api.close()
+
+async def start_warmer(app):
+    """启动后台缓存预热"""
+    warmer.start()
+
+async def stop_warmer(app):
+    """退出时先停止缓存预热，再释放其他资源"""
+    await warmer.stop()
+
 async def init_app():
     """初始化应用"""
+    _create_services()
     app = web.Application()
+    app.on_startup.append(on_startup)
+    # 多进程模式下只由第一个服务进程预热，避免重复拉取
+    if api.config['performance'].get('enable_warmer', True) and supervisor.worker_index() == 0:
+        app.on_startup.append(start_warmer)
+        app.on_cleanup.append(stop_warmer)
+    app.on_cleanup.append(on_cleanup)
     app.router.add_get('/emoticon_api.py', handle_emoticon_api)
     app.router.add_get('/emoticon_api', handle_emoticon_api)
     app.router.add_get('/api/emoticon', handle_emoticon_api)
+    app.router.add_post('/emoticon_api/batch', handle_batch)
+    app.router.add_post('/api/emoticon/batch', handle_batch)
     app.router.add_get('/health', handle_health_check)
-    app.router.add_static('/downloads', path='downloads', name='downloads')
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/downloads/{path:.+}', handle_download, name='downloads')
     return app
 
+async def run_worker():
+    """多进程模式下的服务进程：与其他进程共用端口，开始监听后通知主进程，收到SIGTERM时处理完进行中的请求再退出"""
+    app = await init_app()
+    runner = web.AppRunner(app, access_log=logger, handler_cancellation=True)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT, reuse_port=True).start()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    supervisor.notify_ready()
+    logger.info(f"服务进程 #{supervisor.worker_index()} 已就绪")
+    await stop.wait()
+    await runner.cleanup()
+
 def main():
     """主函数"""
+    parser = argparse.ArgumentParser(description='表情包API服务器')
+    parser.add_argument('--workers', type=int, default=SERVER_CONFIG.get('workers', 1),
+                        help='服务进程数，大于1时由主进程管理多个共用端口的服务进程')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        asyncio.run(run_worker())
+        return
+    if args.workers > 1:
+        if supervisor.reuse_port_supported():
+            logger.info(f"启动表情包API服务器（{args.workers} 个服务进程）...")
+            sys.exit(supervisor.run(__file__, args.workers))
+        logger.warning("当前系统不支持SO_REUSEPORT，以单进程模式运行")
+
     logger.info("启动表情包API服务器...")
     app = init_app()
     web.run_app(
         app,
-        host='0.0.0.0',
-        port=8000,
-        access_log=logger
+        host=HOST,
+        port=PORT,
+        access_log=logger,
+        # 客户端断开时取消请求处理，只有该请求在等待的下载转换随之取消
+        handler_cancellation=True
     )
 
 if __name__ == '__main__':
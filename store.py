@@ -0,0 +1,281 @@
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from pathlib import Path
+from urllib.parse import urlparse
+from typing import Dict, List, Optional, Tuple
+
+import converter
+from cache import connect_sqlite
+
+logger = logging.getLogger(__name__)
+
+STORE_PATH_RE = re.compile(r'^store/[0-9a-f]{2}/([0-9a-f]{40})(?:_([a-z0-9]+))?\.(?:gif|webp|mp4|png)$')
+
+# 原尺寸档位，文件名不带档位后缀
+FULL_TIER = 'full'
+
+
+def tier_image_configs(image_config: Dict) -> Dict[str, Dict]:
+    """各尺寸档位的转换配置：full使用max_image_size，其余档位按size_tiers缩小"""
+    configs = {FULL_TIER: image_config}
+    for tier, size in image_config.get('size_tiers', {}).items():
+        if tier != FULL_TIER:
+            configs[tier] = dict(image_config, max_image_size=min(size, image_config['max_image_size']))
+    return configs
+
+
+class EmojiStore:
+    """按表情包身份寻址的转换结果仓库
+
+    同一个表情包无论出现在哪个关键词下都只转换、存储一份，文件位于
+    store/<key前两位>/<key>.<格式>，缩小的尺寸档位为<key>_<档位>.<格式>，
+    不同格式、不同尺寸的结果并存。索引保存在SQLite中，启动时整体加载到内存，
+    查询不需要逐个stat文件；总大小超过max_bytes时按最近访问时间淘汰到max_bytes的EVICT_TO倍，
+    留出余量，之后的写入不必每次都重新排序淘汰。
+
+    shared=True时（多进程模式）索引由多个进程同时写入：内存未命中时再查SQLite，
+    容量按SQLite中的总大小计算，淘汰也按SQLite中记录的访问时间进行。
+    """
+
+    FLUSH_INTERVAL = 30
+    LOCK_STRIPES = 256
+    EVICT_TO = 0.9
+
+    def __init__(self, download_dir: str, max_bytes: int = 0, db_path: Optional[str] = None, shared: bool = False):
+        self.download_dir = Path(download_dir)
+        self.max_bytes = max_bytes
+        self.shared = shared
+        (self.download_dir / 'store' / '.locks').mkdir(parents=True, exist_ok=True)
+        self._db = connect_sqlite(db_path or str(self.download_dir / 'store.db'))
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path TEXT PRIMARY KEY, key TEXT, size INTEGER, created REAL, last_served REAL, config TEXT, etag TEXT)'
+        )
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(files)')}
+        if 'config' not in columns:
+            # 旧索引没有记录转换配置，补上该列，旧文件的配置视为未知
+            self._add_column('config TEXT')
+        if 'etag' not in columns:
+            # 旧索引没有内容哈希，首次下载时补算
+            self._add_column('etag TEXT')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sources (key TEXT PRIMARY KEY, urls TEXT)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS probes ('
+            'key TEXT PRIMARY KEY, format TEXT, width INTEGER, height INTEGER, frames INTEGER, bytes INTEGER)'
+        )
+        self._files: Dict[str, List] = {}
+        self._dirty = set()
+        self._last_flush = time.monotonic()
+        self.total_bytes = 0
+        for path, size, last_served, etag in self._db.execute('SELECT path, size, last_served, etag FROM files'):
+            self._files[path] = [size, last_served, etag]
+            self.total_bytes += size
+        logger.info(f"表情包仓库已加载 {len(self._files)} 个文件，共 {self.total_bytes / 1024 / 1024:.1f}MB")
+
+    def _add_column(self, column: str):
+        """给旧索引补列；多个服务进程同时启动时可能已由其他进程补上"""
+        try:
+            self._db.execute(f'ALTER TABLE files ADD COLUMN {column}')
+        except sqlite3.OperationalError as e:
+            if 'duplicate column' not in str(e):
+                raise
+
+    @staticmethod
+    def key_for_identity(identity: str) -> str:
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def key_for(emoji: Dict) -> Optional[str]:
+        """表情包身份：优先使用抖音返回的uri，否则使用原图URL路径"""
+        origin = emoji.get('origin', {})
+        identity = origin.get('uri')
+        if not identity:
+            url_list = origin.get('url_list', [])
+            if not url_list:
+                return None
+            identity = urlparse(url_list[0]).path
+        return EmojiStore.key_for_identity(identity)
+
+    @staticmethod
+    def path_for(key: str, ext: str = 'gif', tier: str = FULL_TIER) -> str:
+        """相对download_dir的存储路径"""
+        suffix = '' if tier == FULL_TIER else f'_{tier}'
+        return f"store/{key[:2]}/{key}{suffix}.{ext}"
+
+    def absolute(self, path: str) -> Path:
+        return self.download_dir / path
+
+    def lock_path(self, path: str) -> str:
+        """跨进程转换锁文件，按路径哈希分成固定数量的条带，锁文件数量不会无限增长"""
+        stripe = int(hashlib.sha1(path.encode('utf-8')).hexdigest()[:8], 16) % self.LOCK_STRIPES
+        return str(self.download_dir / 'store' / '.locks' / f"{stripe:03d}.lock")
+
+    def register_sources(self, entries: List[Tuple[str, List[str]]]):
+        """登记表情包的原图地址，供懒转换模式首次访问时下载"""
+        self._db.executemany(
+            'INSERT OR REPLACE INTO sources (key, urls) VALUES (?, ?)',
+            [(key, json.dumps(urls)) for key, urls in entries]
+        )
+
+    def sources(self, key: str) -> Optional[List[str]]:
+        row = self._db.execute('SELECT urls FROM sources WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def probe_info(self, key: str) -> Optional[Dict]:
+        """之前记录的原图探测结果（格式、尺寸、帧数、字节数）"""
+        row = self._db.execute(
+            'SELECT format, width, height, frames, bytes FROM probes WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('format', 'width', 'height', 'frames', 'bytes'), row))
+
+    def record_probe(self, key: str, info: Dict):
+        self._db.execute(
+            'INSERT OR REPLACE INTO probes (key, format, width, height, frames, bytes) VALUES (?, ?, ?, ?, ?, ?)',
+            (key, info['format'], info['width'], info['height'], info['frames'], info['bytes'])
+        )
+
+    @staticmethod
+    def parse_path(path: str) -> Optional[Tuple[str, str]]:
+        """从仓库路径中解析出(key, 尺寸档位)，不是仓库路径时返回None"""
+        match = STORE_PATH_RE.match(path)
+        if not match:
+            return None
+        return match.group(1), match.group(2) or FULL_TIER
+
+    def lookup(self, path: str) -> bool:
+        """文件是否已在仓库中，命中时记录访问时间"""
+        entry = self._files.get(path)
+        if entry is None and self.shared:
+            entry = self._load_shared(path)
+        if entry is None:
+            return False
+        entry[1] = time.time()
+        self._dirty.add(path)
+        self._maybe_flush()
+        return True
+
+    def _load_shared(self, path: str) -> Optional[List]:
+        """从SQLite载入其他进程登记的文件"""
+        row = self._db.execute('SELECT size, last_served, etag FROM files WHERE path = ?', (path,)).fetchone()
+        if row is None or not self.absolute(path).is_file():
+            return None
+        entry = self._files[path] = list(row)
+        self.total_bytes += entry[0]
+        return entry
+
+    def etag(self, path: str) -> Optional[str]:
+        """文件的内容哈希，不在仓库中时返回None；旧索引中没有记录的在此补算"""
+        entry = self._files.get(path)
+        if entry is None and self.shared:
+            entry = self._load_shared(path)
+        if entry is None:
+            return None
+        if entry[2] is None:
+            try:
+                entry[2] = converter.file_digest(str(self.absolute(path)))
+            except OSError:
+                return None
+            self._db.execute('UPDATE files SET etag = ? WHERE path = ?', (entry[2], path))
+        return entry[2]
+
+    def is_current(self, path: str, config: str) -> bool:
+        """文件是否存在且是用指定的转换配置（指纹）生成的"""
+        if path not in self._files:
+            return False
+        row = self._db.execute('SELECT config FROM files WHERE path = ?', (path,)).fetchone()
+        return row is not None and row[0] == config and self.absolute(path).is_file()
+
+    def add(self, path: str, key: str, urls: List[str], config: Optional[str] = None, etag: Optional[str] = None):
+        """登记新转换好的文件；必要时淘汰旧文件
+
+        config为生成时使用的转换配置指纹，etag为文件内容哈希（转换时已算好的直接传入，否则在此计算）。
+        """
+        size = self.absolute(path).stat().st_size
+        if etag is None:
+            etag = converter.file_digest(str(self.absolute(path)))
+        now = time.time()
+        old = self._files.get(path)
+        if old is not None:
+            self.total_bytes -= old[0]
+        self._files[path] = [size, now, etag]
+        self.total_bytes += size
+        self._db.execute(
+            'INSERT OR REPLACE INTO files (path, key, size, created, last_served, config, etag) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (path, key, size, now, now, config, etag)
+        )
+        if urls:
+            self._db.execute('INSERT OR REPLACE INTO sources (key, urls) VALUES (?, ?)', (key, json.dumps(urls)))
+        self._enforce_quota()
+
+    def _enforce_quota(self):
+        """超过容量上限时，从最久未访问的文件开始删除，直到低于上限的EVICT_TO倍"""
+        if not self.max_bytes:
+            return
+        if self.shared:
+            self._enforce_shared_quota()
+            return
+        if self.total_bytes <= self.max_bytes:
+            return
+        target = self.max_bytes * self.EVICT_TO
+        evicted = []
+        for path, (size, *_) in sorted(self._files.items(), key=lambda item: item[1][1]):
+            if self.total_bytes <= target:
+                break
+            self.absolute(path).unlink(missing_ok=True)
+            del self._files[path]
+            self._dirty.discard(path)
+            self.total_bytes -= size
+            evicted.append((path,))
+        self._db.executemany('DELETE FROM files WHERE path = ?', evicted)
+        logger.info(f"仓库超过容量上限，已淘汰 {len(evicted)} 个文件")
+
+    def _enforce_shared_quota(self):
+        """多进程模式：按SQLite中所有进程登记的文件计算总大小并淘汰"""
+        self.flush()
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * self.EVICT_TO
+        evicted = []
+        for path, size in self._db.execute('SELECT path, size FROM files ORDER BY last_served'):
+            if total <= target:
+                break
+            self.absolute(path).unlink(missing_ok=True)
+            entry = self._files.pop(path, None)
+            if entry is not None:
+                self.total_bytes -= entry[0]
+            self._dirty.discard(path)
+            total -= size
+            evicted.append((path,))
+        self._db.executemany('DELETE FROM files WHERE path = ?', evicted)
+        logger.info(f"仓库超过容量上限，已淘汰 {len(evicted)} 个文件")
+
+    def _maybe_flush(self):
+        if time.monotonic() - self._last_flush >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """把内存中的访问时间批量写回SQLite"""
+        self._last_flush = time.monotonic()
+        if not self._dirty:
+            return
+        rows = [(self._files[path][1], path) for path in self._dirty if path in self._files]
+        self._dirty.clear()
+        self._db.executemany('UPDATE files SET last_served = ? WHERE path = ?', rows)
+
+    def stats(self) -> Dict:
+        return {
+            'files': len(self._files),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes
+        }
+
+    def close(self):
+        self.flush()
+        self._db.close()
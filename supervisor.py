@@ -0,0 +1,201 @@
+"""多进程模式：主进程管理N个服务进程，共用同一个端口
+
+    python server.py --workers 4
+
+每个服务进程用SO_REUSEPORT绑定同一端口，由内核分配连接；主进程不处理请求，只负责：
+- 启动服务进程，异常退出的进程重新拉起；
+- 收到SIGHUP时平滑重启：先启动一组新进程，全部就绪后再通知旧进程处理完进行中的请求后退出；
+- 收到SIGTERM/SIGINT时通知所有服务进程退出。
+
+服务进程之间通过SQLite共享分页cursor、上游响应缓存和仓库索引，并用文件锁保证
+同一个表情包、同一个上游查询只由一个进程处理，见EmoticonAPI。
+"""
+import os
+import sys
+import time
+import select
+import signal
+import socket
+import logging
+import subprocess
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 传给服务进程的环境变量：进程序号、进程总数、就绪通知管道
+ENV_WORKER_INDEX = 'EMOJI_API_WORKER_INDEX'
+ENV_WORKER_COUNT = 'EMOJI_API_WORKERS'
+ENV_READY_FD = 'EMOJI_API_READY_FD'
+
+# 服务进程启动到就绪的最长等待时间（秒），包括预热转换进程池
+READY_TIMEOUT = 120
+
+# 旧进程收到SIGTERM后处理完进行中请求的最长时间（秒），超时强制结束
+STOP_TIMEOUT = 60
+
+# 进程异常退出后重新拉起前的等待时间（秒），避免启动即崩溃时反复重启
+RESPAWN_DELAY = 1
+
+
+def worker_index() -> int:
+    """当前服务进程的序号，单进程模式为0"""
+    return int(os.environ.get(ENV_WORKER_INDEX, '0'))
+
+
+def worker_count() -> int:
+    """服务进程总数，单进程模式为1"""
+    return max(1, int(os.environ.get(ENV_WORKER_COUNT, '1')))
+
+
+def reuse_port_supported() -> bool:
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        return False
+    try:
+        with socket.socket() as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return True
+    except OSError:
+        return False
+
+
+def notify_ready():
+    """服务进程开始监听后通知主进程"""
+    fd = os.environ.pop(ENV_READY_FD, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b'1')
+    except OSError:
+        # 异常退出后重新拉起的进程，主进程不等待就绪通知
+        pass
+    finally:
+        os.close(int(fd))
+
+
+class Worker:
+    def __init__(self, index: int, process: subprocess.Popen, ready_fd: int):
+        self.index = index
+        self.process = process
+        self.ready_fd: Optional[int] = ready_fd
+        self.ready = False
+
+    def close_pipe(self):
+        if self.ready_fd is not None:
+            os.close(self.ready_fd)
+            self.ready_fd = None
+
+
+class Supervisor:
+    """启动并看管一组服务进程，command为服务进程的启动命令"""
+
+    def __init__(self, command: List[str], workers: int):
+        self.command = command
+        self.count = workers
+        self.workers: Dict[int, Worker] = {}
+        self._reload = False
+        self._stopping = False
+
+    def _spawn(self, index: int) -> Worker:
+        read_fd, write_fd = os.pipe()
+        env = dict(os.environ)
+        env[ENV_WORKER_INDEX] = str(index)
+        env[ENV_WORKER_COUNT] = str(self.count)
+        env[ENV_READY_FD] = str(write_fd)
+        try:
+            process = subprocess.Popen(self.command, env=env, pass_fds=(write_fd,))
+        finally:
+            os.close(write_fd)
+        logger.info(f"已启动服务进程 #{index}，pid={process.pid}")
+        return Worker(index, process, read_fd)
+
+    def _wait_ready(self, workers: List[Worker]) -> bool:
+        """等待一组进程全部就绪；有进程提前退出或超时返回False"""
+        deadline = time.monotonic() + READY_TIMEOUT
+        pending = {worker.ready_fd: worker for worker in workers}
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select(list(pending), [], [], min(remaining, 1))
+            for fd in readable:
+                worker = pending.pop(fd)
+                worker.ready = os.read(fd, 1) == b'1'
+                worker.close_pipe()
+                if not worker.ready:
+                    return False
+            if any(worker.process.poll() is not None for worker in pending.values()):
+                return False
+        return True
+
+    @staticmethod
+    def _stop(workers: List[Worker]):
+        """通知进程平滑退出，超时后强制结束"""
+        for worker in workers:
+            worker.close_pipe()
+            if worker.process.poll() is None:
+                worker.process.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for worker in workers:
+            try:
+                worker.process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"服务进程 #{worker.index} 未能按时退出，强制结束")
+                worker.process.kill()
+                worker.process.wait()
+
+    def _restart_all(self):
+        """平滑重启：新进程全部就绪后再停掉旧进程，期间端口一直有进程在监听"""
+        logger.info("收到SIGHUP，开始平滑重启")
+        new_workers = [self._spawn(index) for index in range(self.count)]
+        if not self._wait_ready(new_workers):
+            logger.error("新服务进程启动失败，保留原有进程")
+            self._stop(new_workers)
+            return
+        old_workers = list(self.workers.values())
+        self.workers = {worker.index: worker for worker in new_workers}
+        self._stop(old_workers)
+        logger.info("平滑重启完成")
+
+    def _on_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self._reload = True
+        else:
+            self._stopping = True
+
+    def run(self) -> int:
+        signal.signal(signal.SIGHUP, self._on_signal)
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+        self.workers = {index: self._spawn(index) for index in range(self.count)}
+        if not self._wait_ready(list(self.workers.values())):
+            logger.error("服务进程启动失败")
+            self._stop(list(self.workers.values()))
+            return 1
+        logger.info(f"{self.count} 个服务进程已就绪（主进程pid={os.getpid()}，kill -HUP 平滑重启）")
+
+        while not self._stopping:
+            time.sleep(0.5)
+            if self._reload:
+                self._reload = False
+                self._restart_all()
+                continue
+            for index, worker in list(self.workers.items()):
+                code = worker.process.poll()
+                if code is None or self._stopping:
+                    continue
+                logger.error(f"服务进程 #{index} 异常退出（退出码 {code}），{RESPAWN_DELAY}秒后重新启动")
+                worker.close_pipe()
+                time.sleep(RESPAWN_DELAY)
+                self.workers[index] = self._spawn(index)
+                self.workers[index].close_pipe()
+
+        logger.info("正在停止所有服务进程...")
+        self._stop(list(self.workers.values()))
+        return 0
+
+
+def run(script: str, workers: int) -> int:
+    """以多进程模式运行script，服务进程的启动参数为 script --worker"""
+    command = [sys.executable, os.path.abspath(script), '--worker']
+    return Supervisor(command, workers).run()
@@ -0,0 +1,136 @@
+import time
+from collections import deque
+from typing import Dict, List
+from urllib.parse import urlparse
+
+import metrics
+
+# 熔断器状态，同时作为指标值输出
+CLOSED = 0
+OPEN = 1
+HALF_OPEN = 2
+
+# 计算分位数所需的最少样本数，不足时使用配置的默认值
+MIN_SAMPLES = 10
+
+
+def _percentile(samples, q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class HostHealth:
+    """单个上游主机（CDN节点或抖音接口）的近期延迟和熔断状态
+
+    - 记录最近window次成功请求的耗时，用p95决定何时发出对冲请求，用p99乘以系数作为连接和读取超时；
+    - 连续失败failure_threshold次后熔断，cooldown秒内直接跳过该主机；
+    - 冷却结束后进入半开状态，只放行一个探测请求，成功则恢复，失败则继续熔断。
+    下载CDN文件时只统计超时、连接错误和5xx，4xx是请求本身的问题，不算主机故障。
+    """
+
+    def __init__(self, host: str, performance: Dict):
+        self.host = host
+        self.failure_threshold = performance.get('breaker_failures', 5)
+        self.cooldown = performance.get('breaker_cooldown', 30)
+        self.timeout_factor = performance.get('adaptive_timeout_factor', 3)
+        self.min_timeout = performance.get('min_download_timeout', 2)
+        self.default_hedge_delay = performance.get('hedge_delay', 1.0)
+        self._latencies = deque(maxlen=performance.get('latency_window', 100))
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self.successes = 0
+        self.total_failures = 0
+        self.skipped = 0
+
+    def allow(self) -> bool:
+        """是否可以向该主机发请求；半开状态下只放行一个探测请求"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self.state = HALF_OPEN
+            self._probing = False
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def available(self) -> bool:
+        """只查询状态，不占用半开状态的探测名额"""
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= self.cooldown
+        return not (self.state == HALF_OPEN and self._probing)
+
+    def success(self, seconds: float):
+        self._latencies.append(seconds)
+        self.successes += 1
+        self.failures = 0
+        self._probing = False
+        self.state = CLOSED
+
+    def failure(self):
+        self.total_failures += 1
+        self.failures += 1
+        self._probing = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.failures = 0
+
+    def release(self):
+        """请求被取消（对冲请求的另一方先完成）时交还半开状态的探测名额，不计成功或失败"""
+        self._probing = False
+
+    def timeout(self, default: float) -> float:
+        """按近期p99延迟估算的连接和读取超时（sock_connect/sock_read），不超过default；样本不足时使用default
+
+        只限制建立连接和两次读取之间的等待，不作为整个请求的总超时：大文件的响应体可能需要较长时间传完。
+        """
+        if len(self._latencies) < MIN_SAMPLES:
+            return default
+        return min(default, max(self.min_timeout, _percentile(self._latencies, 0.99) * self.timeout_factor))
+
+    def hedge_delay(self) -> float:
+        """主请求超过该时间仍未完成时发出对冲请求：近期p95延迟，样本不足时使用配置值"""
+        if len(self._latencies) < MIN_SAMPLES:
+            return self.default_hedge_delay
+        return max(0.05, _percentile(self._latencies, 0.95))
+
+    def stats(self) -> Dict:
+        return {
+            'state': ('closed', 'open', 'half_open')[self.state],
+            'successes': self.successes,
+            'failures': self.total_failures,
+            'skipped': self.skipped,
+            'p95': round(_percentile(self._latencies, 0.95), 3) if self._latencies else None,
+            'timeout': round(self.timeout(float('inf')), 3) if len(self._latencies) >= MIN_SAMPLES else None
+        }
+
+
+class UpstreamHealth:
+    """按主机名分别维护HostHealth"""
+
+    def __init__(self, performance: Dict):
+        self.performance = performance
+        self._hosts: Dict[str, HostHealth] = {}
+
+    def for_url(self, url: str) -> HostHealth:
+        host = urlparse(url).netloc
+        health = self._hosts.get(host)
+        if health is None:
+            health = self._hosts[host] = HostHealth(host, self.performance)
+        return health
+
+    def order(self, urls: List[str]) -> List[str]:
+        """按可用性排列镜像：熔断中的主机排到最后，其余保持原顺序"""
+        return sorted(urls, key=lambda url: not self.for_url(url).available())
+
+    def update_metrics(self):
+        for host, health in self._hosts.items():
+            metrics.CIRCUIT_STATE.set(health.state, host=host)
+
+    def stats(self) -> Dict[str, Dict]:
+        return {host: health.stats() for host, health in self._hosts.items()}
@@ -0,0 +1,94 @@
+import time
+import asyncio
+import logging
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class CacheWarmer:
+    """后台预热热门查询的第一页
+
+    预热目标为配置的关键词、无关键词的首页类列表，以及线上请求中出现次数最多的前N个查询。
+    每轮依次拉取这些查询的第一页并转换进仓库，每处理一小批表情包前都等待服务空闲，
+    有线上请求、下载或转换任务时暂停，不与线上流量争抢下载和转换资源。
+    """
+
+    def __init__(self, api, performance: Dict):
+        self.api = api
+        self.interval = performance.get('warm_interval', 600)
+        self.start_delay = performance.get('warm_start_delay', 30)
+        self.keywords: List[str] = performance.get('warm_keywords', [])
+        self.feeds: List[str] = performance.get('warm_feeds', ['home'])
+        self.top_n = performance.get('warm_top_n', 50)
+        self.batch_size = max(1, performance.get('warm_batch_size', 4))
+        self.page_size = performance.get('warm_page_size', 40)
+        self.idle_poll = performance.get('warm_idle_poll', 0.5)
+        self._task = None
+        self.runs = 0
+        self.warmed_pages = 0
+        self.warmed_items = 0
+        self.last_run = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"缓存预热已启动，每 {self.interval} 秒一轮")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def targets(self) -> List[Tuple[str, str, str, str]]:
+        """本轮预热的查询(ac, keyword, 格式, 尺寸档位)：配置的在前，其余按热度，去重"""
+        default_format, default_tier = self.api.default_variant()
+        targets = [(ac, '', default_format, default_tier) for ac in self.feeds]
+        targets += [('search', keyword, default_format, default_tier) for keyword in self.keywords]
+        targets += self.api.popular_queries(self.top_n)
+        return list(dict.fromkeys(targets))
+
+    async def _run(self):
+        await asyncio.sleep(self.start_delay)
+        while True:
+            try:
+                await self.warm_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"缓存预热失败: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def warm_once(self):
+        """预热一轮，结束后热度计数减半，热门查询随时间更替"""
+        started = time.time()
+        pages = items = 0
+        for ac, keyword, output_format, size_tier in self.targets():
+            await self._wait_idle()
+            emojis = await self.api.fetch_page(ac, keyword, 0, self.page_size)
+            if not emojis:
+                continue
+            pages += 1
+            for i in range(0, len(emojis), self.batch_size):
+                await self._wait_idle()
+                items += len(await self.api.warm_items(emojis[i:i + self.batch_size], keyword, output_format, size_tier))
+        self.api.decay_popularity()
+        self.runs += 1
+        self.warmed_pages += pages
+        self.warmed_items += items
+        self.last_run = started
+        logger.info(f"缓存预热完成: {pages} 页，{items} 个表情包，耗时 {time.time() - started:.1f}秒")
+
+    async def _wait_idle(self):
+        """等到没有线上请求和排队任务时再继续"""
+        while self.api.is_busy():
+            await asyncio.sleep(self.idle_poll)
+
+    def stats(self) -> Dict:
+        return {
+            'runs': self.runs,
+            'warmed_pages': self.warmed_pages,
+            'warmed_items': self.warmed_items,
+            'last_run': self.last_run
+        }